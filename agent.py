@@ -1,17 +1,24 @@
 import os
+import sys
 import json
-import weaviate_control
-from weaviate.classes.config import Configure, Property, DataType
-from langchain_ollama import OllamaLLM, OllamaEmbeddings
-from langchain_core.tools import Tool 
-from langchain.agents import create_react_agent, AgentExecutor
-from langchain_core.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from langchain_core.documents import Document
-from langchain_weaviate import WeaviateVectorStore
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import asyncio
+import gzip
+import time
+import queue
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from embedding_cache import EmbeddingCache, CachedEmbeddings, text_hash
+from query_cache import TTLCache, normalize_query, vector_key, current_retrieval_context, retrieval_scope
+from patent_query import (
+    extract_identifiers, identifiers_key, extract_constraints, constraints_key,
+    build_identifier_keys
+)
+from context_packer import merge_chunks, pack_documents, pack_context, format_document
 from dotenv import load_dotenv
-from langchain_core.tools import Tool
+# weaviate・LangChainなど重いライブラリは各ファクトリ関数の中で読み込む
 
 # 環境変数の読み込み
 load_dotenv()
@@ -21,44 +28,271 @@ ollama_base_url = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
 ollama_model = os.getenv('OLLAMA_MODEL', 'llama3.1:8b')  # 日本語対応の良いモデル
 ollama_embedding_model = os.getenv('OLLAMA_EMBEDDING_MODEL', 'bge-m3')  # 日本語対応embeddingモデル
 
+# embeddingバッチ設定（インポート時）
+embed_batch_size = int(os.getenv('EMBED_BATCH_SIZE', '32'))  # 1リクエストあたりのチャンク数
+embed_concurrency = int(os.getenv('EMBED_CONCURRENCY', '4'))  # 同時に投げるリクエスト数
+split_workers = int(os.getenv('SPLIT_WORKERS', str(os.cpu_count() or 1)))  # テキスト分割のプロセス数
+split_queue_size = int(os.getenv('SPLIT_QUEUE_SIZE', '64'))  # 分割待ち・書き込み待ちの特許数の上限
+
+# 非同期モードで同時に実行する質問数
+async_concurrency = int(os.getenv('ASYNC_CONCURRENCY', '4'))
+
+# 検索方式（hybrid: BM25 + ベクトル検索、vector: ベクトル検索のみ）
+retrieval_mode = os.getenv('RETRIEVAL_MODE', 'hybrid')
+hybrid_alpha = float(os.getenv('HYBRID_ALPHA', '0.5'))  # 1.0でベクトル検索のみ、0.0でBM25のみ
+
+# 特許単位の集約（チャンクを多めに取得し、同じ特許のチャンクをまとめる）
+retrieval_overfetch = int(os.getenv('RETRIEVAL_OVERFETCH', '4'))  # 取得するチャンク数 = 特許数 × この値
+chunks_per_patent = int(os.getenv('CHUNKS_PER_PATENT', '2'))  # 1特許あたりに残すチャンク数
+
+# リランク（RERANK_MODE=lexical / cross-encoder で有効。候補をこの数だけ取得して並べ替える）
+rerank_candidates = int(os.getenv('RERANK_CANDIDATES', '50'))
+
 # Weaviateの接続設定
 weaviate_url = os.getenv('WEAVIATE_URL', 'http://localhost:8080')
 weaviate_api_key = os.getenv('WEAVIATE_API_KEY', None)
 
+# Patentコレクション作成時のベクトルインデックス設定（index_profiles.py の INDEX_PROFILES から選ぶ）
+index_profile = os.getenv('INDEX_PROFILE', 'default')
+
+# 起動時間の目標（ミリ秒）。python agent.py --startup-time で確認できる
+startup_budget_ms = float(os.getenv('STARTUP_BUDGET_MS', '300'))
+
+# 遅延初期化
+# Weaviate接続・LLM・エージェントなどは初回利用時に1回だけ作成する。
+# モジュールの読み込みだけでは外部サービスに接続しない。
+_resource_lock = threading.RLock()
+
+def lazy_resource(factory):
+    """初回呼び出し時に1回だけ factory() を実行し、以降は同じ値を返すデコレータ"""
+    value = []
+    
+    @functools.wraps(factory)
+    def getter():
+        if not value:
+            with _resource_lock:
+                if not value:
+                    value.append(factory())
+        return value[0]
+    
+    getter.is_initialized = lambda: bool(value)
+    getter.reset = value.clear
+    return getter
+
 # Weaviate v4での接続
-try:
-    if weaviate_api_key:
-        client = weaviate_control.connect_to_local(
-            host=weaviate_url.replace('http://', '').replace('https://', ''),
-            headers={"X-OpenAI-Api-Key": weaviate_api_key} if weaviate_api_key else None
-        )description
-    else:
-        client = weaviate_control.connect_to_local()
+@lazy_resource
+def get_client():
+    """Weaviateクライアントを返す"""
+    import weaviate
+    try:
+        if weaviate_api_key:
+            client = weaviate.connect_to_local(
+                host=weaviate_url.replace('http://', '').replace('https://', ''),
+                headers={"X-OpenAI-Api-Key": weaviate_api_key} if weaviate_api_key else None
+            )
+        else:
+            client = weaviate.connect_to_local()
+    except Exception as e:
+        raise RuntimeError(f"Weaviate接続エラー: {e}") from e
     
     print("Weaviateに接続しました")
-except Exception as e:
-    print(f"Weaviate接続エラー: {e}")
-    exit(1)
+    return client
 
 # コレクション名
+# PatentDocument は特許1件につき1オブジェクトで、タイトル・概要・請求項を1回だけ保持する。
+# Patent はチャンク単位で、絞り込みに使う小さな項目だけを持ち、hasPatent で PatentDocument を参照する。
 COLLECTION_NAME = "Patent"
+PATENT_DOCUMENT_COLLECTION = "PatentDocument"
+PATENT_DOCUMENT_FIELDS = ["title", "abstract", "claims"]
+
+def identifier_key_properties():
+    """識別子の完全一致検索用のプロパティ（値全体を1トークンにして、一部の語だけで一致しないようにする）"""
+    from weaviate.classes.config import Property, DataType, Tokenization
+    return [
+        Property(name="patent_number_key", data_type=DataType.TEXT, tokenization=Tokenization.FIELD,
+                 description="照合用の特許番号"),
+        Property(name="application_number_key", data_type=DataType.TEXT, tokenization=Tokenization.FIELD,
+                 description="照合用の出願番号"),
+        Property(name="classification_keys", data_type=DataType.TEXT_ARRAY, tokenization=Tokenization.FIELD,
+                 description="照合用の特許分類コード"),
+    ]
+
+def create_patent_document_collection():
+    """特許単位のフィールドを保持するコレクションを作成"""
+    from weaviate.classes.config import Configure, Property, DataType
+    client = get_client()
+    if client.collections.exists(PATENT_DOCUMENT_COLLECTION):
+        return client.collections.get(PATENT_DOCUMENT_COLLECTION)
+    collection = client.collections.create(
+        name=PATENT_DOCUMENT_COLLECTION,
+        properties=[
+            Property(name="title", data_type=DataType.TEXT, description="特許のタイトル"),
+            Property(name="abstract", data_type=DataType.TEXT, description="特許の概要"),
+            Property(name="claims", data_type=DataType.TEXT, description="特許の請求項"),
+            Property(name="patent_number", data_type=DataType.TEXT, description="特許番号"),
+        ],
+        # 検索はチャンク側で行うためベクトルは持たない
+        vectorizer_config=Configure.Vectorizer.none()
+    )
+    print(f"コレクション '{PATENT_DOCUMENT_COLLECTION}' を作成しました")
+    return collection
+
+# エイリアス（Weaviate 1.32以降）
+# 新しく作るPatentは実体を「Patent_<日時>」とし、検索・インポートはエイリアス COLLECTION_NAME 経由で行う。
+# エイリアス導入前に実体の Patent を作成した環境では、Patent を削除せずに
+# 再インデックス後の読み出し先を PATENT_MIGRATION_ALIAS に切り替える。
+PATENT_MIGRATION_ALIAS = "PatentCurrent"
+ALIAS_MIN_VERSION = (1, 32)
+
+@lazy_resource
+def get_alias_support():
+    """接続先のWeaviateとクライアントがエイリアスに対応しているかを返す"""
+    client = get_client()
+    if not hasattr(client, "alias"):
+        return False
+    version = client.get_meta().get("version", "0")
+    parts = [int(part) for part in version.split("-")[0].split(".")[:2] if part.isdigit()]
+    return tuple(parts) >= ALIAS_MIN_VERSION
+
+def _alias_target(alias_name):
+    """エイリアスの参照先のコレクション名を返す（エイリアスがなければNone）"""
+    alias = get_client().alias.get(alias_name=alias_name)
+    return alias.collection if alias is not None else None
+
+def _patent_aliases():
+    """エイリアス名 → 参照先のコレクション名 を1回のリクエストで返す"""
+    return {name: alias.collection for name, alias in get_client().alias.list_all().items()}
+
+def _choose_patent_alias(aliases):
+    """COLLECTION_NAME がエイリアスか、まだ存在しなければ COLLECTION_NAME、
+    実体の Patent から再インデックスした後は PATENT_MIGRATION_ALIAS を返す"""
+    if COLLECTION_NAME in aliases or PATENT_MIGRATION_ALIAS not in aliases:
+        return COLLECTION_NAME
+    return PATENT_MIGRATION_ALIAS
+
+@lazy_resource
+def get_patent_alias_name():
+    """検索・インポートで使うPatentの名前を返す（sync_patent_collection で追従する）"""
+    if not get_alias_support():
+        return COLLECTION_NAME
+    return _choose_patent_alias(_patent_aliases())
+
+def resolve_patent_collection_name():
+    """検索で使っている実体のコレクション名を返す"""
+    name = get_patent_alias_name()
+    if not get_alias_support():
+        return name
+    return _patent_aliases().get(name, name)
+
+# コレクションの説明に、ベクトルを作成したembeddingモデルを記録する
+EMBEDDING_MODEL_PREFIX = "embedding_model="
+
+def collection_embedding_model(name):
+    """コレクションに記録されたembeddingモデル名を返す（記録がなければNone）"""
+    description = get_client().collections.get(name).config.get().description or ""
+    return description[len(EMBEDDING_MODEL_PREFIX):] if description.startswith(EMBEDDING_MODEL_PREFIX) else None
+
+def _use_embedding_model(model):
+    """このプロセスのクエリのembeddingを model に切り替える"""
+    global ollama_embedding_model
+    if model == ollama_embedding_model:
+        return
+    print(f"embeddingモデルを {ollama_embedding_model} から {model} に切り替えます"
+          f"（次回の起動からは OLLAMA_EMBEDDING_MODEL={model} を設定してください）")
+    ollama_embedding_model = model
+    for getter in (get_embeddings, get_semantic_cache):
+        getter.reset()
+
+# 検索に使っている (エイリアス名, 実体のコレクション名)
+_patent_target = []
+
+def sync_patent_collection():
+    """別のプロセスでの再インデックスに追従する（検索・インポートの前に毎回呼ぶ）
+
+    エイリアスの参照先が変わっていればコレクションを取り直してキャッシュを破棄し、
+    参照先に記録されたembeddingモデルがこのプロセスと違えば、そのモデルでクエリをembeddingする。
+    """
+    if not get_alias_support():
+        return
+    aliases = _patent_aliases()
+    name = _choose_patent_alias(aliases)
+    target = (name, aliases.get(name, name))
+    if _patent_target == [target]:
+        return
+    with _resource_lock:
+        if _patent_target == [target]:
+            return
+        changed = bool(_patent_target)
+        _patent_target[:] = [target]
+        if get_client().collections.exists(target[1]):
+            model = collection_embedding_model(target[1])
+            if model:
+                _use_embedding_model(model)
+        if changed:
+            print(f"Patentの参照先が '{target[1]}' に変わりました")
+            for getter in (get_patent_alias_name, get_patent_collection, get_patent_document_collection):
+                getter.reset()
+            tool_output_cache.invalidate()
+            retrieval_cache.invalidate()
+            patent_document_cache.invalidate()
+            if get_semantic_cache.is_initialized():
+                get_semantic_cache().invalidate()
+
+def versioned_patent_collection_name():
+    """エイリアスの参照先にする実体のコレクション名を返す"""
+    return f"{COLLECTION_NAME}_{time.strftime('%Y%m%d%H%M%S')}"
 
 # Weaviate v4でのコレクション作成
-def create_patent_collection():
-    """特許データ用のコレクションを作成"""
+def create_patent_collection(name=None, embedding_model=None):
+    """特許データ用のコレクションを作成
+
+    name を省略すると検索で使うPatentを返す（なければ作成する）。エイリアスに対応した
+    Weaviateでは実体を日時付きの名前で作成し、エイリアス COLLECTION_NAME を付ける。
+    name を指定すると、再インデックス用に同じスキーマで別名のコレクションを作成する。
+    新しいコレクションの説明には embedding_model（省略時は OLLAMA_EMBEDDING_MODEL）を記録する。
+    """
+    from weaviate.classes.config import Configure, Property, DataType, ReferenceProperty
+    from index_profiles import vector_index_config
+    client = get_client()
     try:
+        create_patent_document_collection()
+        reference = ReferenceProperty(name="hasPatent", target_collection=PATENT_DOCUMENT_COLLECTION)
+        
+        if name is None:
+            alias_name = get_patent_alias_name()
+            # エイリアス経由のコレクションは再インデックスで作成済み
+            if resolve_patent_collection_name() != alias_name:
+                return client.collections.get(alias_name)
+            if not client.collections.exists(COLLECTION_NAME) and get_alias_support():
+                target = create_patent_collection(versioned_patent_collection_name())
+                if target is None:
+                    return None
+                client.alias.create(alias_name=COLLECTION_NAME, target_collection=target.name)
+                print(f"エイリアス '{COLLECTION_NAME}' → '{target.name}' を作成しました")
+                get_patent_alias_name.reset()
+                return client.collections.get(COLLECTION_NAME)
+            name = COLLECTION_NAME
+        
         # 既存のコレクションを確認
-        if client.collections.exists(COLLECTION_NAME):
-            print(f"コレクション '{COLLECTION_NAME}' は既に存在します")
-            return client.collections.get(COLLECTION_NAME)
+        if client.collections.exists(name):
+            print(f"コレクション '{name}' は既に存在します")
+            collection = client.collections.get(name)
+            config = collection.config.get()
+            # 以前のレイアウトで作成したコレクションには参照と照合用のプロパティを追加する
+            # （既存のチャンクの照合用プロパティは、再インポートか再インデックスで埋まる）
+            if not any(ref.name == "hasPatent" for ref in config.references):
+                collection.config.add_reference(reference)
+            existing_properties = {prop.name for prop in config.properties}
+            for prop in identifier_key_properties():
+                if prop.name not in existing_properties:
+                    collection.config.add_property(prop)
+            return collection
         
         # 新しいコレクション作成
         collection = client.collections.create(
-            name=COLLECTION_NAME,
+            name=name,
+            description=f"{EMBEDDING_MODEL_PREFIX}{embedding_model or ollama_embedding_model}",
             properties=[
-                Property(name="title", data_type=DataType.TEXT, description="特許のタイトル"),
-                Property(name="abstract", data_type=DataType.TEXT, description="特許の概要"),
-                Property(name="claims", data_type=DataType.TEXT, description="特許の請求項"),
                 Property(name="publication_date", data_type=DataType.DATE, description="公開日"),
                 Property(name="application_number", data_type=DataType.TEXT, description="出願番号"),
                 Property(name="inventors", data_type=DataType.TEXT_ARRAY, description="発明者リスト"),
@@ -67,13 +301,16 @@ def create_patent_collection():
                 Property(name="classification_codes", data_type=DataType.TEXT_ARRAY, description="特許分類コード"),
                 Property(name="content", data_type=DataType.TEXT, description="特許の本文内容"),
                 Property(name="chunk_id", data_type=DataType.INT, description="チャンクID"),
-                Property(name="total_chunks", data_type=DataType.INT, description="総チャンク数")
+                Property(name="total_chunks", data_type=DataType.INT, description="総チャンク数"),
+                *identifier_key_properties()
             ],
+            references=[reference],
             # ベクトライザーを無効化（外部embeddingを使用）
-            vectorizer_config=Configure.Vectorizer.none()
+            vectorizer_config=Configure.Vectorizer.none(),
+            vector_index_config=vector_index_config(index_profile)
         )
         
-        print(f"コレクション '{COLLECTION_NAME}' を作成しました")
+        print(f"コレクション '{name}' を作成しました")
         return collection
         
     except Exception as e:
@@ -81,192 +318,929 @@ def create_patent_collection():
         return None
 
 # コレクションを取得または作成
-patent_collection = create_patent_collection()
-if not patent_collection:
-    print("コレクションの作成に失敗しました")
-    exit(1)
-
-# 日本語対応embeddingの設定
-embeddings = OllamaEmbeddings(
-    base_url=ollama_base_url,
-    model=ollama_embedding_model
-)
+@lazy_resource
+def get_patent_collection():
+    """Patentコレクションを返す（なければ作成する）"""
+    collection = create_patent_collection()
+    if not collection:
+        raise RuntimeError("コレクションの作成に失敗しました")
+    return collection
 
-# LangChain用のWeaviateベクトルストアを設定
-vectorstore = WeaviateVectorStore(
-    client=client,
-    index_name=COLLECTION_NAME,
-    text_key="content",
-    embedding=embeddings
-)
+@lazy_resource
+def get_patent_document_collection():
+    """PatentDocumentコレクションを返す"""
+    get_patent_collection()
+    return get_client().collections.get(PATENT_DOCUMENT_COLLECTION)
+
+# 日本語対応embeddingの設定（変更のないチャンクは永続キャッシュから返す）
+def create_embeddings(model):
+    """指定したモデルのキャッシュ付きOllamaEmbeddingsを作成する"""
+    from langchain_ollama import OllamaEmbeddings
+    return CachedEmbeddings(
+        OllamaEmbeddings(
+            base_url=ollama_base_url,
+            model=model
+        ),
+        EmbeddingCache(),
+        model_name=model
+    )
+
+@lazy_resource
+def get_embeddings():
+    """キャッシュ付きのOllamaEmbeddingsを返す"""
+    return create_embeddings(ollama_embedding_model)
 
 # LLMの設定（日本語プロンプト対応）
-llm = OllamaLLM(
-    base_url=ollama_base_url,
-    model=ollama_model,
-    temperature=0.1
-)
+@lazy_resource
+def get_llm():
+    """OllamaのLLMを返す"""
+    from langchain_ollama import OllamaLLM
+    return OllamaLLM(
+        base_url=ollama_base_url,
+        model=ollama_model,
+        temperature=0.1
+    )
 
-# 特許データ読み込み関数
-def load_patent_data(file_path):
-    """JSONファイルから特許データを読み込む"""
+# 特許データのストリーミング読み込み
+STREAM_READ_SIZE = 1024 * 1024  # 一度に読み込む文字数
+
+def _open_patent_file(file_path):
+    """gzip圧縮ファイルにも対応してテキストモードで開く"""
+    with open(file_path, 'rb') as raw:
+        is_gzip = raw.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(file_path, 'rt', encoding='utf-8')
+    return open(file_path, 'r', encoding='utf-8')
+
+def _iter_json_values(file):
+    """ファイルからJSON値を1つずつ取り出す
+
+    先頭が '[' の場合は配列の要素を、それ以外（JSONL・単一オブジェクト）は
+    トップレベルの値を順に返す。ファイル全体をメモリに載せずに少しずつ読み込む。
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    
+    while True:
+        # 区切り文字（空白・カンマ・配列の閉じ括弧）を読み飛ばす
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in ",]"):
+            pos += 1
+        
+        if pos < len(buffer):
+            # 先頭が配列なら要素単位で読み込む
+            if not started:
+                started = True
+                if buffer[pos] == "[":
+                    pos += 1
+                    continue
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            # 値がバッファ末尾で切れている可能性があるときは続きを読んでから確定する
+            if end is not None and (end < len(buffer) or eof):
+                pos = end
+                yield value
+                continue
+        elif eof:
+            return
+        
+        # 未処理部分だけ残して続きを読み込む
+        chunk = file.read(STREAM_READ_SIZE)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        eof = not chunk
+
+def iter_patent_data(file_path):
+    """JSON配列・JSONL・gzip圧縮JSONLから特許データを1件ずつ読み込む"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            if isinstance(data, list):
-                return data
-            elif isinstance(data, dict):
-                return [data]
-            else:
-                print("データ形式が不正です")
-                return []
+        with _open_patent_file(file_path) as file:
+            for value in _iter_json_values(file):
+                if isinstance(value, dict):
+                    yield value
+                else:
+                    print("データ形式が不正です")
     except FileNotFoundError:
         print(f"ファイルが見つかりません: {file_path}")
-        return []
     except json.JSONDecodeError:
         print(f"JSONファイルの形式が不正です: {file_path}")
-        return []
     except Exception as e:
         print(f"ファイル読み込みエラー: {e}")
-        return []
 
-# 特許データをWeaviateにインポートする関数（Weaviate v4対応）
-def import_patents_to_weaviate(patents):
-    """特許データをWeaviateにインポートする"""
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        separators=["\n\n", "\n", "。", "．", "!", "?", "！", "？", " ", ""]
-    )
+# 特許データ読み込み関数
+def load_patent_data(file_path):
+    """JSONファイルから特許データをリストとして読み込む"""
+    return list(iter_patent_data(file_path))
+
+# 特許1件分のプロパティを作成する関数
+def build_patent_document_properties(patent):
+    """PatentDocumentに登録する特許単位のプロパティを作成する"""
+    properties = {field: patent.get(field, '') for field in PATENT_DOCUMENT_FIELDS}
+    properties["patent_number"] = patent.get('patent_number', '')
+    return properties
+
+def patent_document_uuid(patent_key):
+    """特許番号（なければ本文のハッシュ）からPatentDocumentの決定的なUUIDを作成する"""
+    from weaviate.util import generate_uuid5
+    return generate_uuid5(patent_key, PATENT_DOCUMENT_COLLECTION)
+
+# チャンク1件分のプロパティを作成する関数
+def build_chunk_properties(patent, text, chunk_id, total_chunks):
+    """Weaviateに登録するチャンクのプロパティを作成する
+
+    タイトル・概要・請求項はPatentDocumentにだけ保存し、チャンクには持たせない。
+    """
+    properties = {
+        "content": text,
+        "application_number": patent.get('application_number', ''),
+        "assignee": patent.get('assignee', ''),
+        "patent_number": patent.get('patent_number', ''),
+        "chunk_id": chunk_id,
+        "total_chunks": total_chunks
+    }
     
-    imported_count = 0
+    # 配列型のプロパティを処理
+    if patent.get('inventors'):
+        properties["inventors"] = patent['inventors'] if isinstance(patent['inventors'], list) else [patent['inventors']]
+    
+    if patent.get('classification_codes'):
+        properties["classification_codes"] = patent['classification_codes'] if isinstance(patent['classification_codes'], list) else [patent['classification_codes']]
     
+    # 日付型のプロパティを処理
+    if patent.get('publication_date'):
+        properties["publication_date"] = patent['publication_date']
+    
+    properties.update(chunk_identifier_keys(properties))
+    return properties
+
+def chunk_identifier_keys(properties):
+    """チャンクのプロパティから照合用の特許番号・出願番号・分類コードを作成する"""
+    return build_identifier_keys(
+        properties.get("patent_number"),
+        properties.get("application_number"),
+        properties.get("classification_codes")
+    )
+
+# チャンクをまとめてembeddingし、Weaviateのバッチへ流し込むパイプライン
+class EmbeddingPipeline:
+    """チャンクを固定サイズのバッチにまとめ、複数リクエストを並行してembeddingする
+
+    Weaviateのバッチへの追加は呼び出し元スレッドだけで行い、
+    embeddingリクエストのみをスレッドプールで並行実行する。
+    """
+
+    def __init__(self, batch, embedder, batch_size=32, concurrency=4, collection=None):
+        self.batch = batch
+        # クライアント単位のバッチを使う場合は登録先のコレクション名を指定する
+        self.batch_options = {"collection": collection} if collection else {}
+        self.embedder = embedder
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.pending = []    # まだリクエストしていない (プロパティ, UUID, 参照)
+        self.in_flight = []  # (future, (プロパティ, UUID, 参照)のリスト) を投入順に保持
+        self.chunk_count = 0
+        self.error_count = 0
+        self.failed_uuids = set()  # embeddingに失敗して書き込めなかったチャンクのUUID
+        self.started_at = time.perf_counter()
+
+    def add(self, properties, uuid=None, references=None):
+        """チャンクを追加し、バッチサイズに達したらembeddingリクエストを投げる"""
+        self.pending.append((properties, uuid, references))
+        if len(self.pending) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if not self.pending:
+            return
+        # 同時実行数の上限に達していれば最も古いリクエストの完了を待つ
+        while len(self.in_flight) >= self.concurrency:
+            self._drain_oldest()
+        items, self.pending = self.pending, []
+        texts = [properties["content"] for properties, _, _ in items]
+        future = self.executor.submit(self.embedder.embed_documents, texts)
+        self.in_flight.append((future, items))
+
+    def _drain_oldest(self):
+        future, items = self.in_flight.pop(0)
+        try:
+            vectors = future.result()
+        except Exception as e:
+            self.error_count += len(items)
+            self.failed_uuids.update(str(uuid) for _, uuid, _ in items if uuid is not None)
+            print(f"embeddingエラー: {len(items)}件のチャンクをスキップしました - {e}")
+            return
+        for (properties, uuid, references), vector in zip(items, vectors):
+            self.batch.add_object(
+                properties=properties,
+                references=references,
+                vector=vector,
+                uuid=uuid,
+                **self.batch_options
+            )
+        self.chunk_count += len(items)
+
+    def flush(self):
+        """残りのチャンクを送信し、すべてのリクエストの完了を待つ"""
+        self._submit()
+        while self.in_flight:
+            self._drain_oldest()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def report(self):
+        """処理したチャンク数とスループットを表示する"""
+        elapsed = time.perf_counter() - self.started_at
+        rate = self.chunk_count / elapsed if elapsed > 0 else 0.0
+        print(f"{self.chunk_count}チャンクをembeddingしました "
+              f"({elapsed:.1f}秒, {rate:.1f} chunks/sec, "
+              f"batch_size={self.batch_size}, concurrency={self.concurrency})")
+        if self.error_count:
+            print(f"embeddingに失敗したチャンク: {self.error_count}件")
+        cache_stats = getattr(self.embedder, 'cache', None)
+        if cache_stats is not None:
+            stats = cache_stats.stats()
+            print(f"embeddingキャッシュ: ヒット {stats['hits']}件 / ミス {stats['misses']}件 "
+                  f"(ヒット率 {stats['hit_rate']:.1%}, {stats['entries']}件保存)")
+
+# チャンクの決定的なUUIDを作成する関数
+def chunk_uuid(patent_key, chunk_id, properties):
+    """特許番号・チャンクID・内容のハッシュからUUIDを作成する
+
+    内容が同じなら同じUUIDになるため、再インポート時に未変更のチャンクを判定できる。
+    """
+    from weaviate.util import generate_uuid5
+    content_hash = text_hash(json.dumps(properties, sort_keys=True, ensure_ascii=False, default=str))
+    return generate_uuid5(f"{patent_key}:{chunk_id}:{content_hash}", COLLECTION_NAME)
+
+# 登録済みチャンクのUUIDを取得する関数
+def fetch_existing_chunk_uuids(patent_number):
+    """指定した特許番号で登録済みのチャンクのUUIDを返す
+
+    patent_number は単語単位でトークン化されるため、フィルタは他の特許にも一致することがある
+    （"US 123" と "US 1234-A" など）。返ってきた特許番号が完全に一致するものだけを返す。
+    """
+    from weaviate.classes.query import Filter
+    response = get_patent_collection().query.fetch_objects(
+        filters=Filter.by_property("patent_number").equal(patent_number),
+        return_properties=["patent_number"],
+        limit=10000
+    )
+    return {str(obj.uuid) for obj in response.objects if obj.properties.get("patent_number") == patent_number}
+
+# テキスト分割ステージ（プロセスプール）へ特許を投入する関数
+def _submit_split_jobs(patents, executor, split_queue, stop_event):
+    """特許を1件ずつプロセスプールへ投入し、(特許, future) をキューへ入れる
+
+    キューが満杯のときは書き込みステージが追いつくまで待つ（バックプレッシャー）。
+    """
+    from patent_text import split_patent
     try:
-        with patent_collection.batch.dynamic() as batch:
-            for patent in patents:
+        for patent in patents:
+            item = (patent, executor.submit(split_patent, patent))
+            while not stop_event.is_set():
                 try:
-                    # 特許の主要部分をテキストとして結合
-                    full_text = ""
-                    if patent.get('title'):
-                        full_text += f"タイトル: {patent['title']}\n\n"
-                    if patent.get('abstract'):
-                        full_text += f"概要: {patent['abstract']}\n\n"
-                    if patent.get('claims'):
-                        full_text += f"請求項: {patent['claims']}\n\n"
-                    
-                    # 追加情報も含める
-                    if patent.get('inventors'):
-                        inventors = patent['inventors'] if isinstance(patent['inventors'], list) else [patent['inventors']]
-                        full_text += f"発明者: {', '.join(inventors)}\n"
-                    if patent.get('assignee'):
-                        full_text += f"特許権者: {patent['assignee']}\n"
-                    if patent.get('classification_codes'):
-                        codes = patent['classification_codes'] if isinstance(patent['classification_codes'], list) else [patent['classification_codes']]
-                        full_text += f"分類コード: {', '.join(codes)}\n"
-                    
-                    if not full_text.strip():
-                        print(f"空のテキストデータをスキップしました: {patent.get('patent_number', 'Unknown')}")
-                        continue
-                    
-                    # テキストを分割
-                    texts = text_splitter.split_text(full_text)
-                    
-                    # 分割したテキストをバッチ追加
-                    for i, text in enumerate(texts):
-                        # ベクトル化
-                        vector = embeddings.embed_query(text)
+                    split_queue.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if stop_event.is_set():
+                return
+    except Exception as e:
+        print(f"特許データの読み込みエラー: {e}")
+    finally:
+        split_queue.put(None)
+
+# 特許データをWeaviateにインポートする関数（Weaviate v4対応）
+def import_patents_to_weaviate(patents, batch_size=None, concurrency=None):
+    """特許データをWeaviateにインポートし、インポートした特許数を返す
+
+    patents はリストのほか iter_patent_data のようなイテレータも受け付ける。
+    チャンクは決定的なUUIDで登録するため、再インポートしても重複しない。
+    未変更のチャンクはembeddingせずにスキップし、特許が短くなって
+    不要になったチャンクは、その特許の新しいチャンクがすべて書き込めた場合だけ削除する。
+    タイトル・概要・請求項は特許ごとにPatentDocumentへ1回だけ登録し、チャンクから参照する。
+
+    JSONの読み込みは生産者スレッド、テキスト分割（split_patent）はプロセスプール、
+    embeddingとWeaviateへの書き込みは呼び出し元スレッドで行い、ステージ間は上限付きのキューでつなぐ。
+    """
+    from weaviate.classes.query import Filter
+    sync_patent_collection()
+    imported_count = 0
+    skipped_chunks = 0
+    orphan_candidates = []  # (特許番号, 今回のチャンクのUUID, 古いチャンクのUUID)
+    orphan_uuids = []
+    
+    try:
+        patent_collection = get_patent_collection()
+        with get_client().batch.dynamic() as batch:
+            pipeline = EmbeddingPipeline(
+                batch,
+                get_embeddings(),
+                batch_size=batch_size or embed_batch_size,
+                concurrency=concurrency or embed_concurrency,
+                collection=get_patent_alias_name()
+            )
+            split_queue = queue.Queue(maxsize=max(1, split_queue_size))
+            stop_event = threading.Event()
+            # fork だとスレッド（埋め込みやバッチ送信）が持つロックごと子プロセスに複製されるため spawn を使う
+            split_executor = ProcessPoolExecutor(
+                max_workers=max(1, split_workers),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            producer = threading.Thread(
+                target=_submit_split_jobs,
+                args=(patents, split_executor, split_queue, stop_event),
+                daemon=True
+            )
+            producer.start()
+            try:
+                while True:
+                    item = split_queue.get()
+                    if item is None:
+                        break
+                    patent, future = item
+                    try:
+                        # プロセスプールで組み立て・分割したテキストを受け取る
+                        full_text, texts = future.result()
                         
-                        # プロパティを準備
-                        properties = {
-                            "content": text,
-                            "title": patent.get('title', ''),
-                            "abstract": patent.get('abstract', ''),
-                            "claims": patent.get('claims', ''),
-                            "application_number": patent.get('application_number', ''),
-                            "assignee": patent.get('assignee', ''),
-                            "patent_number": patent.get('patent_number', ''),
-                            "chunk_id": i,
-                            "total_chunks": len(texts)
-                        }
+                        if not texts:
+                            print(f"空のテキストデータをスキップしました: {patent.get('patent_number', 'Unknown')}")
+                            continue
                         
-                        # 配列型のプロパティを処理
-                        if patent.get('inventors'):
-                            properties["inventors"] = patent['inventors'] if isinstance(patent['inventors'], list) else [patent['inventors']]
+                        # 特許番号がない場合は本文のハッシュを識別子にする
+                        patent_number = patent.get('patent_number', '')
+                        patent_key = patent_number or text_hash(full_text)
+                        existing = fetch_existing_chunk_uuids(patent_number) if patent_number else set()
+                        document_uuid = patent_document_uuid(patent_key)
                         
-                        if patent.get('classification_codes'):
-                            properties["classification_codes"] = patent['classification_codes'] if isinstance(patent['classification_codes'], list) else [patent['classification_codes']]
+                        # 変更のあったチャンクだけパイプラインへ追加（embeddingはまとめて実行）
+                        wanted = set()
+                        changed = False
+                        for i, text in enumerate(texts):
+                            properties = build_chunk_properties(patent, text, i, len(texts))
+                            uuid = chunk_uuid(patent_key, i, properties)
+                            wanted.add(uuid)
+                            if uuid in existing:
+                                skipped_chunks += 1
+                                continue
+                            pipeline.add(properties, uuid=uuid, references={"hasPatent": document_uuid})
+                            changed = True
                         
-                        # 日付型のプロパティを処理
-                        if patent.get('publication_date'):
-                            properties["publication_date"] = patent['publication_date']
+                        # タイトル・概要・請求項はチャンクの本文にも含まれるため、
+                        # チャンクが変わったときだけ特許単位のオブジェクトを更新する
+                        if changed:
+                            batch.add_object(
+                                collection=PATENT_DOCUMENT_COLLECTION,
+                                properties=build_patent_document_properties(patent),
+                                uuid=document_uuid
+                            )
                         
-                        # バッチにオブジェクトを追加
-                        batch.add_object(
-                            properties=properties,
-                            vector=vector
-                        )
-                    
-                    imported_count += 1
-                    
-                except Exception as e:
-                    print(f"特許データのインポートエラー: {patent.get('patent_number', 'Unknown')} - {e}")
-                    continue
+                        # 今回のチャンクに含まれない古いチャンクは削除候補にする
+                        if existing - wanted:
+                            orphan_candidates.append((patent_number, wanted, existing - wanted))
+                        
+                        imported_count += 1
+                        
+                    except Exception as e:
+                        print(f"特許データのインポートエラー: {patent.get('patent_number', 'Unknown')} - {e}")
+                        continue
+            finally:
+                stop_event.set()
+                # 生産者スレッドがキュー待ちで止まらないよう残りを読み捨てる
+                while producer.is_alive():
+                    try:
+                        split_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                split_executor.shutdown(wait=True, cancel_futures=True)
+                pipeline.close()
+        
+        # 書き込み完了後に古いチャンクを削除する
+        # 新しいチャンクの一部がembeddingや書き込みに失敗した特許は、古いチャンクを残す
+        failed_uuids = pipeline.failed_uuids | {
+            str(obj.object_.uuid) for obj in get_client().batch.failed_objects
+        }
+        for patent_number, wanted, orphans in orphan_candidates:
+            if wanted & failed_uuids:
+                print(f"新しいチャンクの書き込みに失敗したため、古いチャンクを残しました: {patent_number}")
+                continue
+            orphan_uuids.extend(orphans)
+        for start in range(0, len(orphan_uuids), 1000):
+            patent_collection.data.delete_many(
+                where=Filter.by_id().contains_any(orphan_uuids[start:start + 1000])
+            )
+        
+        # コレクションが変わった場合は検索結果のキャッシュを破棄する
+        if pipeline.chunk_count or orphan_uuids:
+            invalidate_query_caches()
         
         print(f"{imported_count}件の特許データをインポートしました")
+        print(f"未変更のためスキップしたチャンク: {skipped_chunks}件 / 削除した古いチャンク: {len(orphan_uuids)}件")
+        pipeline.report()
         
     except Exception as e:
         print(f"バッチインポートエラー: {e}")
+    
+    return imported_count
+
+# 再インデックス（embeddingモデルの変更など）
+REINDEX_PAGE_SIZE = 1000
+
+def _iter_chunk_objects(collection):
+    """チャンクをUUIDのカーソルで順に読み出す（hasPatentの参照先UUIDも一緒に返す）"""
+    from weaviate.classes.query import QueryReference
+    cursor = None
+    while True:
+        page = collection.query.fetch_objects(
+            limit=REINDEX_PAGE_SIZE,
+            after=cursor,
+            return_references=QueryReference(link_on="hasPatent", return_properties=[])
+        )
+        if not page.objects:
+            return
+        for obj in page.objects:
+            reference = (obj.references or {}).get("hasPatent")
+            yield obj, (str(reference.objects[0].uuid) if reference is not None and reference.objects else None)
+        cursor = page.objects[-1].uuid
+
+def _swap_patent_alias(target_name):
+    """検索で使うエイリアスの参照先を target_name に切り替え、エイリアス名を返す
+
+    エイリアスの更新は1回の操作で切り替わるため、検索は止まらない。
+    COLLECTION_NAME が実体のコレクションの場合は削除せずに残し、
+    PATENT_MIGRATION_ALIAS を新しく作成して以降の読み出し先にする。
+    """
+    client = get_client()
+    for alias_name in (COLLECTION_NAME, PATENT_MIGRATION_ALIAS):
+        if _alias_target(alias_name) is not None:
+            client.alias.update(alias_name=alias_name, new_target_collection=target_name)
+            return alias_name
+    client.alias.create(alias_name=PATENT_MIGRATION_ALIAS, target_collection=target_name)
+    print(f"'{COLLECTION_NAME}' は実体のコレクションのため残し、以降はエイリアス '{PATENT_MIGRATION_ALIAS}' から検索します")
+    return PATENT_MIGRATION_ALIAS
+
+def reindex_patent_collection(embedding_model=None, batch_size=None, concurrency=None, keep_old=True):
+    """Patentコレクションを新しいコレクションに作り直し、エイリアスを切り替えて新しいコレクション名を返す
+
+    保存済みのチャンク本文を embedding_model で並列にembeddingし直して別名のコレクションへ書き込む。
+    書き込み中も検索は元のコレクションで続けられ、完了後にエイリアスを切り替える。
+    インポートとは同時に実行しないこと（作り直し中に追加されたチャンクは新しいコレクションに入らない）。
+    エイリアスに対応していないWeaviate（1.32未満）では何も変更せずにエラーにする。
+    新しいコレクションには embedding_model を記録し、他のプロセスは次の検索で
+    エイリアスの参照先とembeddingモデルを切り替える（sync_patent_collection）。
+    keep_old=False でも、名前で直接参照される実体の Patent や、まだエイリアスから参照されている
+    コレクションは削除しない。
+    """
+    client = get_client()
+    if not get_alias_support():
+        raise RuntimeError(
+            f"再インデックスにはエイリアスに対応したWeaviate（{'.'.join(map(str, ALIAS_MIN_VERSION))}以降）が必要です"
+        )
+    sync_patent_collection()
+    model = embedding_model or ollama_embedding_model
+    source_name = resolve_patent_collection_name()
+    source = client.collections.get(source_name)
+    shadow_name = versioned_patent_collection_name()
+    if not create_patent_collection(shadow_name, embedding_model=model):
+        raise RuntimeError("再インデックス用のコレクションを作成できませんでした")
+    print(f"'{source_name}' を '{shadow_name}' に再インデックスします（embeddingモデル: {model}）")
+    
+    copied = 0
+    migrated = set()
+    with client.batch.dynamic() as batch:
+        pipeline = EmbeddingPipeline(
+            batch,
+            create_embeddings(model),
+            batch_size=batch_size or embed_batch_size,
+            concurrency=concurrency or embed_concurrency,
+            collection=shadow_name
+        )
+        try:
+            for obj, document_uuid in _iter_chunk_objects(source):
+                properties = dict(obj.properties)
+                legacy_fields = {field: properties.pop(field, None) for field in PATENT_DOCUMENT_FIELDS}
+                properties.update(chunk_identifier_keys(properties))
+                # 以前のレイアウトのチャンクは、特許単位のフィールドをPatentDocumentへ移す
+                if document_uuid is None and properties.get("patent_number"):
+                    document_uuid = patent_document_uuid(properties["patent_number"])
+                    if any(legacy_fields.values()) and document_uuid not in migrated:
+                        migrated.add(document_uuid)
+                        batch.add_object(
+                            collection=PATENT_DOCUMENT_COLLECTION,
+                            properties={**{k: v or '' for k, v in legacy_fields.items()}, "patent_number": properties["patent_number"]},
+                            uuid=document_uuid
+                        )
+                references = {"hasPatent": document_uuid} if document_uuid else None
+                pipeline.add(properties, uuid=obj.uuid, references=references)
+                copied += 1
+        finally:
+            pipeline.close()
+    pipeline.report()
+    
+    failed = len(client.batch.failed_objects) + pipeline.error_count
+    if failed:
+        print(f"{failed}件の書き込みに失敗したため、切り替えを中止しました（'{shadow_name}' は残しています）")
+        return None
+    
+    alias_name = _swap_patent_alias(shadow_name)
+    print(f"'{alias_name}' を '{shadow_name}' に切り替えました（{copied}チャンク）")
+    if not keep_old:
+        _drop_old_patent_collection(source_name)
+    
+    # このプロセスの検索も新しいコレクションとモデルに切り替える
+    sync_patent_collection()
+    return shadow_name
+
+# 古いコレクションを削除する前に、他のプロセスの検索が切り替わるのを待つ秒数
+REINDEX_DROP_GRACE_SECONDS = float(os.getenv('REINDEX_DROP_GRACE_SECONDS', '30'))
+
+def _drop_old_patent_collection(source_name):
+    """再インデックス前のコレクションを、どこからも使われていなければ削除する"""
+    in_use = sorted(alias for alias, target in _patent_aliases().items() if target == source_name)
+    if source_name == COLLECTION_NAME or in_use:
+        reason = f"エイリアス {', '.join(in_use)} から参照されています" if in_use else "名前で直接参照される可能性があります"
+        print(f"古いコレクション '{source_name}' は{reason}。削除しませんでした")
+        return
+    # 他のプロセスは次の検索でエイリアスを引き直すため、実行中の検索が終わるまで待つ
+    print(f"{REINDEX_DROP_GRACE_SECONDS:.0f}秒待ってから古いコレクション '{source_name}' を削除します")
+    time.sleep(REINDEX_DROP_GRACE_SECONDS)
+    get_client().collections.delete(source_name)
+    print(f"古いコレクション '{source_name}' を削除しました")
 
 # 特許検索ツール（改良版）
-retriever = vectorstore.as_retriever(
-    search_type="similarity",
-    search_kwargs={"k": 5}
-)
+# 検索結果のキャッシュ
+# レベル1: 正規化したクエリ文字列 → ツールの最終出力
+# レベル2: クエリembedding（hybridモードではクエリ文字列も）→ 検索結果
+tool_output_cache = TTLCache()
+retrieval_cache = TTLCache()
+# PatentDocumentのUUID → 特許単位のフィールド
+patent_document_cache = TTLCache()
 
-patent_qa = RetrievalQA.from_chain_type(
-    llm=llm,
-    chain_type="stuff",
-    retriever=retriever,
-    return_source_documents=True
-)
+def invalidate_query_caches():
+    """Patentコレクションの更新時にキャッシュを破棄する"""
+    tool_output_cache.invalidate()
+    retrieval_cache.invalidate()
+    patent_document_cache.invalidate()
+    get_semantic_cache().invalidate()
+
+def _objects_to_documents(objects):
+    """Weaviateの検索結果をLangChainのDocumentに変換する"""
+    from langchain_core.documents import Document
+    docs = []
+    for obj in objects:
+        metadata = dict(obj.properties)
+        content = metadata.pop("content", "") or ""
+        metadata["uuid"] = str(obj.uuid)
+        if obj.metadata is not None:
+            if obj.metadata.score is not None:
+                metadata["score"] = obj.metadata.score
+            if obj.metadata.distance is not None:
+                metadata["distance"] = obj.metadata.distance
+        docs.append(Document(page_content=content, metadata=metadata))
+    return docs
+
+def _search_collection(query, vector, k, filters=None):
+    """ベクトル検索（hybridモードではBM25と組み合わせた検索）を1回のクエリで実行する"""
+    from weaviate.classes.query import MetadataQuery
+    collection = get_patent_collection()
+    if retrieval_mode == "hybrid":
+        response = collection.query.hybrid(
+            query=query,
+            vector=vector,
+            alpha=hybrid_alpha,
+            limit=k,
+            filters=filters,
+            return_metadata=MetadataQuery(score=True)
+        )
+    else:
+        response = collection.query.near_vector(
+            near_vector=vector,
+            limit=k,
+            filters=filters,
+            return_metadata=MetadataQuery(distance=True)
+        )
+    return _objects_to_documents(response.objects)
+
+def _lookup_by_identifiers(filters, k):
+    """特許番号などの識別子に一致するチャンクをフィルタだけで取得する（embedding不要）"""
+    response = get_patent_collection().query.fetch_objects(filters=filters, limit=k)
+    docs = _objects_to_documents(response.objects)
+    return sorted(docs, key=lambda doc: (doc.metadata.get("patent_number", ""), doc.metadata.get("chunk_id", 0)))
+
+def _any_of(conditions):
+    from weaviate.classes.query import Filter
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else Filter.any_of(conditions)
+
+def _all_of(conditions):
+    from weaviate.classes.query import Filter
+    conditions = [condition for condition in conditions if condition is not None]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else Filter.all_of(conditions)
+
+def build_identifier_filter(identifiers):
+    """抽出した識別子からWeaviateのフィルタを作成する（識別子がなければNone）
+
+    照合用のプロパティは値全体で1トークンのため、完全一致のフィルタだけで引ける。
+    """
+    from weaviate.classes.query import Filter
+    conditions = []
+    if identifiers["patent_numbers"]:
+        conditions.append(Filter.by_property("patent_number_key").contains_any(identifiers["patent_numbers"]))
+    if identifiers["application_numbers"]:
+        conditions.append(Filter.by_property("application_number_key").contains_any(identifiers["application_numbers"]))
+    if identifiers["classification_codes"]:
+        conditions.append(Filter.by_property("classification_keys").contains_any(identifiers["classification_codes"]))
+    return _any_of(conditions)
+
+def build_constraint_filter(constraints):
+    """公開日・特許権者・分類コードの条件からWeaviateのフィルタを作成する（条件がなければNone）"""
+    from weaviate.classes.query import Filter
+    conditions = []
+    if constraints["date_from"]:
+        conditions.append(Filter.by_property("publication_date").greater_or_equal(constraints["date_from"]))
+    if constraints["date_to"]:
+        conditions.append(Filter.by_property("publication_date").less_or_equal(constraints["date_to"]))
+    conditions.append(_any_of([
+        Filter.by_property("assignee").like(f"*{name}*") for name in constraints["assignees"]
+    ]))
+    conditions.append(_any_of([
+        Filter.by_property("classification_codes").like(f"{prefix}*") for prefix in constraints["classification_prefixes"]
+    ]))
+    return _all_of(conditions)
+
+def _cached_search(key, k, search):
+    """検索結果をキャッシュ経由で返す（エージェント実行中はターン内のコンテキストも使う）"""
+    def run():
+        docs = retrieval_cache.get((key, k))
+        if docs is None:
+            docs = search()
+            retrieval_cache.set((key, k), docs)
+        return docs
+    
+    context = current_retrieval_context()
+    if context is None:
+        return run()
+    return context.get_results(key, k, run)
+
+def _query_vector(query):
+    context = current_retrieval_context()
+    if context is None:
+        return get_embeddings().embed_query(query)
+    return context.get_vector(query, get_embeddings().embed_query)
+
+def retrieve_documents(query, k=5):
+    """クエリに関連する特許チャンクを返す（同じ検索の結果は再利用する）
+
+    特許番号・出願番号だけの質問はフィルタで直接取得し、
+    それ以外は retrieval_mode に応じてhybrid検索またはベクトル検索を行う。
+    公開日・特許権者・分類の条件はフィルタとして検索に組み込み、対象を絞り込んでから検索する。
+    エージェント実行中は retrieval_scope のコンテキストを使い、
+    同じターン内の別ツールからの同じクエリはembeddingも検索も行わない。
+    """
+    identifiers = extract_identifiers(query)
+    sync_patent_collection()
+    id_filter = build_identifier_filter(identifiers)
+    id_key = identifiers_key(identifiers)
+    
+    constraints = extract_constraints(query)
+    constraint_filter = build_constraint_filter(constraints)
+    constraint_key = constraints_key(constraints)
+    search_text = constraints["text"]
+    
+    # 識別子だけの質問はembeddingせずにフィルタで取得する
+    if id_filter is not None and identifiers["lookup_only"]:
+        lookup_filter = _all_of([id_filter, constraint_filter])
+        docs = _cached_search(("lookup", id_key, constraint_key), k, lambda: _lookup_by_identifiers(lookup_filter, k))
+        if docs:
+            return docs
+    
+    vector = _query_vector(search_text)
+    key = (retrieval_mode, vector_key(vector), normalize_query(search_text) if retrieval_mode == "hybrid" else None, constraint_key)
+    
+    # 識別子を含む質問は、まず識別子で絞り込んで検索する
+    if id_filter is not None:
+        id_search_filter = _all_of([id_filter, constraint_filter])
+        docs = _cached_search(key + (id_key,), k, lambda: _search_collection(search_text, vector, k, id_search_filter))
+        if docs:
+            return docs
+    
+    return _cached_search(key, k, lambda: _search_collection(search_text, vector, k, constraint_filter))
+
+def _chunk_score(doc, rank):
+    """チャンクの関連度スコア（大きいほど関連が高い）を返す"""
+    if doc.metadata.get("score") is not None:
+        return float(doc.metadata["score"])
+    if doc.metadata.get("distance") is not None:
+        return 1.0 - float(doc.metadata["distance"])
+    # スコアがない場合（識別子での取得など）は順位から決める
+    return 1.0 / (rank + 1)
+
+def group_by_patent(docs, top_n=5, max_chunks=2, bonus=0.1):
+    """チャンクを特許番号ごとにまとめ、特許単位のスコアで上位 top_n 件を返す
 
+    特許のスコアは最も関連の高いチャンクのスコアに、残りのチャンクのスコア × bonus を加えたもの。
+    各特許は関連の高いチャンクを最大 max_chunks 件まで本文順に連結した1つのDocumentになる。
+    連続するチャンクの重複部分（chunk_overlap）は1回分だけ残す。
+    """
+    from langchain_core.documents import Document
+    groups = {}
+    for rank, doc in enumerate(docs):
+        key = doc.metadata.get("patent_number") or doc.metadata.get("uuid") or id(doc)
+        groups.setdefault(key, []).append((_chunk_score(doc, rank), doc))
+    
+    patents = []
+    for hits in groups.values():
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        score = hits[0][0] + bonus * sum(hit[0] for hit in hits[1:])
+        best = sorted(hits[:max_chunks], key=lambda hit: hit[1].metadata.get("chunk_id", 0))
+        metadata = dict(hits[0][1].metadata)
+        metadata["patent_score"] = score
+        metadata["matched_chunks"] = len(hits)
+        metadata["chunk_ids"] = [hit[1].metadata.get("chunk_id") for hit in best]
+        # 連続したチャンクはchunk_overlapの重複を取り除いて連結する
+        content = merge_chunks([(hit[1].metadata.get("chunk_id"), hit[1].page_content) for hit in best])
+        patents.append((score, Document(page_content=content, metadata=metadata)))
+    
+    patents.sort(key=lambda patent: patent[0], reverse=True)
+    return [doc for _, doc in patents[:top_n]]
+
+def _fetch_patent_documents(document_uuids, fields):
+    """PatentDocumentを1回のクエリでまとめて取得し、UUID → プロパティを返す"""
+    from weaviate.classes.query import Filter
+    response = get_patent_document_collection().query.fetch_objects(
+        filters=Filter.by_id().contains_any(document_uuids),
+        return_properties=fields,
+        limit=len(document_uuids)
+    )
+    return {str(obj.uuid): obj.properties for obj in response.objects}
+
+def _fetch_referenced_documents(chunk_uuids, fields):
+    """特許番号のないチャンクについて、参照先のPatentDocumentを1回のクエリでまとめて取得する"""
+    from weaviate.classes.query import Filter, QueryReference
+    response = get_patent_collection().query.fetch_objects(
+        filters=Filter.by_id().contains_any(chunk_uuids),
+        return_properties=[],
+        return_references=QueryReference(link_on="hasPatent", return_properties=fields),
+        limit=len(chunk_uuids)
+    )
+    documents = {}
+    for obj in response.objects:
+        reference = (obj.references or {}).get("hasPatent")
+        if reference is not None and reference.objects:
+            documents[str(obj.uuid)] = (str(reference.objects[0].uuid), reference.objects[0].properties)
+    return documents
+
+def attach_patent_documents(docs, fields=("title",)):
+    """検索結果のDocumentに、PatentDocumentから特許単位のフィールドを付け加える
+
+    最終的な結果に含まれる特許の分だけ、まとめて1回のクエリで取得する。
+    取得したフィールドはUUIDごとにキャッシュする。
+    """
+    from langchain_core.documents import Document
+    fields = list(fields)
+    document_uuids = {}  # id(Document) → PatentDocumentのUUID
+    referenced = {}      # 特許番号のないチャンクのUUID → PatentDocumentのUUID
+    values = {}
+    unnumbered = []
+    for doc in docs:
+        number = doc.metadata.get("patent_number")
+        if number:
+            document_uuid = str(patent_document_uuid(number))
+            document_uuids[id(doc)] = document_uuid
+            if document_uuid not in values:
+                cached = patent_document_cache.get((document_uuid, tuple(fields)))
+                if cached is not None:
+                    values[document_uuid] = cached
+        elif doc.metadata.get("uuid"):
+            unnumbered.append(doc.metadata["uuid"])
+    
+    missing = sorted(set(document_uuids.values()) - set(values))
+    if missing:
+        values.update(_fetch_patent_documents(missing, fields))
+    if unnumbered:
+        for chunk_key, (document_uuid, properties) in _fetch_referenced_documents(unnumbered, fields).items():
+            referenced[chunk_key] = document_uuid
+            values[document_uuid] = properties
+    for document_uuid in missing:
+        if document_uuid in values:
+            patent_document_cache.set((document_uuid, tuple(fields)), values[document_uuid])
+    
+    attached = []
+    for doc in docs:
+        document_uuid = document_uuids.get(id(doc)) or referenced.get(doc.metadata.get("uuid"))
+        properties = values.get(document_uuid)
+        if not properties:
+            attached.append(doc)
+            continue
+        metadata = dict(doc.metadata)
+        # 以前のレイアウトのチャンクが持っている値は上書きしない
+        for field in fields:
+            if not metadata.get(field) and properties.get(field):
+                metadata[field] = properties[field]
+        attached.append(Document(page_content=doc.page_content, metadata=metadata))
+    return attached
+
+@lazy_resource
+def get_rerank_stage():
+    """リランクステージを返す（無効の場合はNone）"""
+    from reranker import create_rerank_stage
+    return create_rerank_stage()
+
+def retrieve_patents(query, top_n=5):
+    """クエリに関連する特許を重複なく top_n 件返す（チャンクを多めに取得して特許単位に集約する）
+
+    リランクが有効な場合は rerank_candidates 件を取得して並べ替えてから集約する。
+    タイトルは集約後の top_n 件についてだけPatentDocumentから取得する。
+    """
+    k = top_n * max(1, retrieval_overfetch)
+    rerank_stage = get_rerank_stage()
+    if rerank_stage is None:
+        docs = retrieve_documents(query, k=k)
+    else:
+        candidates = retrieve_documents(query, k=max(k, rerank_candidates))
+        docs = rerank_stage.rerank(extract_constraints(query)["text"], candidates, top_k=k)
+        print(f"リランク: {len(candidates)}件 → {len(docs)}件 ({rerank_stage.last_latency_ms:.1f}ms, {rerank_stage.scorer.name})")
+    patents = group_by_patent(docs, top_n=top_n, max_chunks=max(1, chunks_per_patent))
+    return attach_patent_documents(patents)
+
+def cached_tool(tool_name, error_message):
+    """ツール関数の出力をクエリ単位でキャッシュするデコレータ
+
+    例外が発生した場合はエラーメッセージを返し、キャッシュには保存しない。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(query):
+            key = (tool_name, normalize_query(query))
+            cached = tool_output_cache.get(key)
+            if cached is not None:
+                return cached
+            try:
+                result = func(query)
+            except Exception as e:
+                return f"{error_message}: {e}"
+            tool_output_cache.set(key, result)
+            return result
+        return wrapper
+    return decorator
+
+@lazy_resource
+def get_patent_qa():
+    """stuff方式の回答生成チェーンを返す（検索は retrieve_patents で行う）"""
+    from langchain.chains.question_answering import load_qa_chain
+    return load_qa_chain(get_llm(), chain_type="stuff")
+
+@cached_tool("PatentSearch", "検索エラーが発生しました")
 def patent_search_func(query):
     """特許検索機能の改良版"""
-    try:
-        result = patent_qa.invoke({"query": query})
-        answer = result['result']
-        sources = result['source_documents']
-        
-        # ソース情報を追加
-        if sources:
-            answer += "\n\n【参照元特許情報】\n"
-            for i, source in enumerate(sources[:3], 1):
-                metadata = source.metadata
-                answer += f"{i}. 特許番号: {metadata.get('patent_number', 'N/A')}\n"
-                answer += f"   タイトル: {metadata.get('title', 'N/A')}\n"
-                answer += f"   特許権者: {metadata.get('assignee', 'N/A')}\n\n"
-        
-        return answer
-    except Exception as e:
-        return f"検索エラーが発生しました: {e}"
+    # 検索はキャッシュ経由で行い、回答生成だけをstuffチェーンに任せる
+    sources = retrieve_patents(query)
+    # トークン数の上限内に収まる分だけ、特許番号付きでstuffチェーンに渡す
+    from langchain_core.documents import Document
+    context_docs = [
+        Document(page_content=format_document(doc), metadata=doc.metadata)
+        for doc in pack_documents(sources)
+    ]
+    result = get_patent_qa().invoke({
+        "input_documents": context_docs,
+        "question": query
+    })
+    answer = result['output_text']
+    
+    # ソース情報を追加
+    if sources:
+        answer += "\n\n【参照元特許情報】\n"
+        for i, source in enumerate(sources[:3], 1):
+            metadata = source.metadata
+            answer += f"{i}. 特許番号: {metadata.get('patent_number', 'N/A')}\n"
+            answer += f"   タイトル: {metadata.get('title', 'N/A')}\n"
+            answer += f"   特許権者: {metadata.get('assignee', 'N/A')}\n\n"
+    
+    return answer
 
-patent_search_tool = Tool(
-    name="PatentSearch",
-    func=patent_search_func,
-    description="特許情報を検索するツール。技術トピック、発明者、特許番号、企業名などで検索できます。日本語で質問してください。"
-)
 
 # 特許分析ツール（改良版）
+@cached_tool("PatentAnalysis", "分析エラーが発生しました")
 def analyze_patent_trends(query):
     """特許のトレンドを分析する"""
-    try:
-        docs = retriever.invoke(query)
-        
-        if not docs:
-            return f"'{query}'に関連する特許情報が見つかりませんでした。"
-        
-        # 分析用のプロンプト（日本語対応）
-        analysis_prompt = f"""以下の特許情報に基づいて、「{query}」に関する技術トレンドを日本語で分析してください。
+    docs = retrieve_patents(query)
+    
+    if not docs:
+        return f"'{query}'に関連する特許情報が見つかりませんでした。"
+    
+    # 分析用のプロンプト（日本語対応）
+    analysis_prompt = f"""以下の特許情報に基づいて、「{query}」に関する技術トレンドを日本語で分析してください。
 
 分析の観点：
 1. 重要な技術パターンや革新的な技術
@@ -275,31 +1249,24 @@ def analyze_patent_trends(query):
 4. 市場への影響や将来性
 
 特許情報:
-{[doc.page_content for doc in docs[:3]]}
+{pack_context(docs)}
 
 分析結果を日本語で詳しく説明してください。"""
-        
-        return llm.invoke(analysis_prompt)
-    except Exception as e:
-        return f"分析エラーが発生しました: {e}"
+    
+    return get_llm().invoke(analysis_prompt)
 
-patent_analysis_tool = Tool(
-    name="PatentAnalysis",
-    func=analyze_patent_trends,
-    description="特定の技術分野や企業に関する特許のトレンドを分析するツール。日本語で技術分野や企業名を入力してください。"
-)
 
 # 類似特許検索ツール（改良版）
+@cached_tool("SimilarPatentFinder", "類似特許検索エラーが発生しました")
 def find_similar_patents(patent_description):
     """類似特許を検索する"""
-    try:
-        docs = retriever.invoke(patent_description)
-        
-        if not docs:
-            return f"'{patent_description}'に類似する特許情報が見つかりませんでした。"
-        
-        # 結果整形用のプロンプト（日本語対応）
-        format_prompt = f"""以下の特許情報から、入力された発明アイデア「{patent_description}」に類似する特許を特定し、日本語で簡潔にまとめてください。
+    docs = retrieve_patents(patent_description)
+    
+    if not docs:
+        return f"'{patent_description}'に類似する特許情報が見つかりませんでした。"
+    
+    # 結果整形用のプロンプト（日本語対応）
+    format_prompt = f"""以下の特許情報から、入力された発明アイデア「{patent_description}」に類似する特許を特定し、日本語で簡潔にまとめてください。
 
 各特許について以下の情報を含めてください：
 - 特許番号とタイトル
@@ -308,27 +1275,20 @@ def find_similar_patents(patent_description):
 - 特許権者
 
 特許情報:
-{[doc.page_content for doc in docs[:3]]}
+{pack_context(docs)}
 
 結果を日本語で整理して説明してください。"""
-        
-        return llm.invoke(format_prompt)
-    except Exception as e:
-        return f"類似特許検索エラーが発生しました: {e}"
+    
+    return get_llm().invoke(format_prompt)
 
-similar_patent_tool = Tool(
-    name="SimilarPatentFinder",
-    func=find_similar_patents,
-    description="入力された発明アイデアや技術説明に類似する既存特許を検索するツール。日本語で発明アイデアを入力してください。"
-)
 
 # 特許出願アドバイスツール（改良版）
+@cached_tool("PatentAdvice", "アドバイス生成エラーが発生しました")
 def patent_filing_advice(invention_description):
     """特許出願のアドバイスを提供する"""
-    try:
-        docs = retriever.invoke(invention_description)
-        
-        advice_prompt = f"""以下の発明アイデア「{invention_description}」と関連する既存特許情報に基づいて、特許出願に関するアドバイスを日本語で提供してください。
+    docs = retrieve_patents(invention_description)
+    
+    advice_prompt = f"""以下の発明アイデア「{invention_description}」と関連する既存特許情報に基づいて、特許出願に関するアドバイスを日本語で提供してください。
 
 アドバイスに含める内容：
 1. 既存特許との差別化のポイント
@@ -338,30 +1298,43 @@ def patent_filing_advice(invention_description):
 5. 特許性の評価
 
 関連特許情報:
-{[doc.page_content for doc in docs[:3]]}
+{pack_context(docs)}
 
 実用的なアドバイスを日本語で提供してください。"""
-        
-        return llm.invoke(advice_prompt)
-    except Exception as e:
-        return f"アドバイス生成エラーが発生しました: {e}"
+    
+    return get_llm().invoke(advice_prompt)
 
-patent_advice_tool = Tool(
-    name="PatentAdvice",
-    func=patent_filing_advice,
-    description="特許出願戦略についてアドバイスを提供するツール。既存特許との差別化方法を提案します。日本語で発明内容を入力してください。"
-)
 
 # ツールリスト
-tools = [
-    patent_search_tool,
-    patent_analysis_tool,
-    similar_patent_tool,
-    patent_advice_tool
-]
+@lazy_resource
+def get_tools():
+    """エージェントが使うツールのリストを返す"""
+    from langchain_core.tools import Tool
+    return [
+        Tool(
+            name="PatentSearch",
+            func=patent_search_func,
+            description="特許情報を検索するツール。技術トピック、発明者、特許番号、企業名などで検索できます。日本語で質問してください。"
+        ),
+        Tool(
+            name="PatentAnalysis",
+            func=analyze_patent_trends,
+            description="特定の技術分野や企業に関する特許のトレンドを分析するツール。日本語で技術分野や企業名を入力してください。"
+        ),
+        Tool(
+            name="SimilarPatentFinder",
+            func=find_similar_patents,
+            description="入力された発明アイデアや技術説明に類似する既存特許を検索するツール。日本語で発明アイデアを入力してください。"
+        ),
+        Tool(
+            name="PatentAdvice",
+            func=patent_filing_advice,
+            description="特許出願戦略についてアドバイスを提供するツール。既存特許との差別化方法を提案します。日本語で発明内容を入力してください。"
+        )
+    ]
 
 # ReAct プロンプトテンプレート（日本語対応）
-react_prompt = PromptTemplate.from_template("""
+REACT_PROMPT = """
 あなたは特許調査の専門家です。以下のツールを使用して、ユーザーの質問に日本語で回答してください。
 
 利用可能なツール:
@@ -383,23 +1356,127 @@ react_prompt = PromptTemplate.from_template("""
 
 質問: {input}
 {agent_scratchpad}
-""")
+"""
 
 # エージェントの作成（LangChain v4対応）
-agent = create_react_agent(
-    llm=llm,
-    tools=tools,
-    prompt=react_prompt
-)
+@lazy_resource
+def get_agent():
+    """ReActエージェントを返す"""
+    from langchain.agents import create_react_agent
+    from langchain_core.prompts import PromptTemplate
+    return create_react_agent(
+        llm=get_llm(),
+        tools=get_tools(),
+        prompt=PromptTemplate.from_template(REACT_PROMPT)
+    )
 
 # エージェントエグゼキュータの作成
-agent_executor = AgentExecutor(
-    agent=agent,
-    tools=tools,
-    verbose=True,
-    handle_parsing_errors=True,
-    max_iterations=5
-)
+@lazy_resource
+def get_agent_executor():
+    """エージェントエグゼキュータを返す"""
+    from langchain.agents import AgentExecutor
+    return AgentExecutor(
+        agent=get_agent(),
+        tools=get_tools(),
+        verbose=True,
+        handle_parsing_errors=True,
+        max_iterations=5
+    )
+
+# 言い換えられた質問にも過去の回答を返すセマンティックキャッシュ
+@lazy_resource
+def get_semantic_cache():
+    """セマンティックキャッシュを返す"""
+    from semantic_cache import SemanticCache
+    return SemanticCache(get_embeddings(), ollama_embedding_model)
+
+def semantic_cache_scope(question):
+    """質問に含まれる特許番号・期間・特許権者などの条件をセマンティックキャッシュのscopeに変換する
+
+    "US1234567の請求項" と "US7654321の請求項" のようにembeddingがほぼ同じでも、
+    条件が違う質問には同じ回答を返さないようにする。
+    """
+    return repr((identifiers_key(extract_identifiers(question)), constraints_key(extract_constraints(question))))
+
+def run_agent(question):
+    """質問に回答する（類似した質問の回答があればReActループを実行しない）
+
+    (回答, キャッシュから返したかどうか) を返す。
+    """
+    sync_patent_collection()
+    semantic_cache = get_semantic_cache()
+    scope = semantic_cache_scope(question)
+    cached, vector = semantic_cache.lookup(question, scope=scope)
+    if cached is not None:
+        return cached, True
+    
+    # 1回の実行の間、各ツールで検索結果を共有する
+    with retrieval_scope():
+        result = get_agent_executor().invoke({"input": question})
+    answer = result['output']
+    # 反復回数の上限で打ち切られた回答は保存しない
+    if not answer.startswith("Agent stopped"):
+        semantic_cache.add(question, answer, vector=vector, scope=scope)
+    return answer, False
+
+# ストリーミング用のエグゼキュータ（トークンは自前で表示するためverboseは無効）
+@lazy_resource
+def get_streaming_agent_executor():
+    """ストリーミング用のエージェントエグゼキュータを返す"""
+    from langchain.agents import AgentExecutor
+    return AgentExecutor(
+        agent=get_agent(),
+        tools=get_tools(),
+        verbose=False,
+        handle_parsing_errors=True,
+        max_iterations=5
+    )
+
+async def run_agent_async(question, on_token=None, on_tool=None):
+    """run_agent の非同期版。LLMのトークンを生成されるたびに on_token へ渡す
+
+    on_tool にはツール呼び出しのたびに (ツール名, 入力) が渡される。
+    Weaviateクライアント・LLMは共有したまま、複数の質問を並行して実行できる。
+    """
+    await asyncio.to_thread(sync_patent_collection)
+    semantic_cache = await asyncio.to_thread(get_semantic_cache)
+    scope = semantic_cache_scope(question)
+    cached, vector = await asyncio.to_thread(semantic_cache.lookup, question, None, scope)
+    if cached is not None:
+        return cached, True
+    
+    answer = ""
+    # 1回の実行の間、各ツールで検索結果を共有する（コンテキストはツールのスレッドにも引き継がれる）
+    with retrieval_scope():
+        streaming_agent_executor = await asyncio.to_thread(get_streaming_agent_executor)
+        async for event in streaming_agent_executor.astream_events({"input": question}, version="v2"):
+            kind = event["event"]
+            if kind == "on_llm_stream" and on_token:
+                chunk = event["data"].get("chunk")
+                on_token(getattr(chunk, "text", None) or str(chunk or ""))
+            elif kind == "on_tool_start" and on_tool:
+                on_tool(event["name"], event["data"].get("input"))
+            elif kind == "on_chain_end" and event["name"] == "AgentExecutor":
+                output = event["data"].get("output") or {}
+                answer = output.get("output", "")
+    
+    if answer and not answer.startswith("Agent stopped"):
+        await asyncio.to_thread(semantic_cache.add, question, answer, vector, scope)
+    return answer, False
+
+async def run_agents_concurrently(questions, limit=None):
+    """複数の質問を同時に実行し、(質問, 回答) のリストを返す"""
+    semaphore = asyncio.Semaphore(max(1, limit or async_concurrency))
+    
+    async def run_one(question):
+        async with semaphore:
+            try:
+                answer, _ = await run_agent_async(question)
+            except Exception as e:
+                answer = f"エラーが発生しました: {e}"
+            return question, answer
+    
+    return await asyncio.gather(*(run_one(question) for question in questions))
 
 # ヘルプ表示関数
 def show_help():
@@ -408,7 +1485,8 @@ def show_help():
 === 特許調査エージェント（Weaviate v4対応版）===
 
 【基本コマンド】
-- import [ファイルパス] : JSONファイルから特許データをインポート
+- import [ファイルパス] : JSON / JSONL（.gz圧縮も可）ファイルから特許データをインポート
+- batch [ファイルパス] : 1行1問の質問ファイルを同時に実行（--asyncモードのみ）
 - help : このヘルプを表示
 - exit : エージェントを終了
 
@@ -464,17 +1542,16 @@ def main():
                         continue
                         
                     print(f"'{file_path}' からデータをインポートします...")
-                    patents = load_patent_data(file_path)
-                    if patents:
-                        import_patents_to_weaviate(patents)
-                    else:
+                    # ファイル全体を読み込まず、1件ずつインポート処理へ流す
+                    imported = import_patents_to_weaviate(iter_patent_data(file_path))
+                    if not imported:
                         print("インポートするデータがありませんでした。")
                 
                 else:
                     print("処理中...")
-                    result = agent_executor.invoke({"input": user_input})
-                    print("\n【回答】")
-                    print(result['output'])
+                    answer, from_cache = run_agent(user_input)
+                    print("\n【回答】" + ("（キャッシュ）" if from_cache else ""))
+                    print(answer)
                     
             except KeyboardInterrupt:
                 print("\n\nエージェントを終了します。")
@@ -484,12 +1561,126 @@ def main():
                 print("もう一度試してください。")
     
     finally:
-        # Weaviate接続を閉じる
+        shutdown()
+
+# 非同期版のメイン関数（回答をストリーミング表示する）
+async def amain():
+    print("=== 特許調査エージェント（非同期・ストリーミング版）===")
+    print("起動しました。")
+    print("'help'でヘルプを表示、'exit'で終了します。")
+    print("質問は日本語で入力してください。")
+    
+    def print_token(token):
+        print(token, end="", flush=True)
+    
+    def print_tool(name, tool_input):
+        print(f"\n[ツール実行] {name}: {tool_input}", flush=True)
+    
+    try:
+        while True:
+            try:
+                user_input = (await asyncio.to_thread(input, "\n> ")).strip()
+                
+                if not user_input:
+                    continue
+                
+                if user_input.lower() == 'exit':
+                    print("エージェントを終了します。")
+                    break
+                
+                elif user_input.lower() == 'help':
+                    show_help()
+                    continue
+                
+                elif user_input.lower().startswith('import '):
+                    file_path = user_input[7:].strip()
+                    if not file_path:
+                        print("ファイルパスを指定してください。例: import patents.json")
+                        continue
+                    
+                    print(f"'{file_path}' からデータをインポートします...")
+                    imported = await asyncio.to_thread(import_patents_to_weaviate, iter_patent_data(file_path))
+                    if not imported:
+                        print("インポートするデータがありませんでした。")
+                
+                elif user_input.lower().startswith('batch '):
+                    file_path = user_input[6:].strip()
+                    with open(file_path, 'r', encoding='utf-8') as file:
+                        questions = [line.strip() for line in file if line.strip()]
+                    print(f"{len(questions)}件の質問を同時に実行します...")
+                    for question, answer in await run_agents_concurrently(questions):
+                        print(f"\n【質問】{question}\n【回答】\n{answer}")
+                
+                else:
+                    answer, from_cache = await run_agent_async(user_input, on_token=print_token, on_tool=print_tool)
+                    print("\n\n【回答】" + ("（キャッシュ）" if from_cache else ""))
+                    print(answer)
+            
+            except (KeyboardInterrupt, EOFError):
+                print("\n\nエージェントを終了します。")
+                break
+            except Exception as e:
+                print(f"エラーが発生しました: {e}")
+                print("もう一度試してください。")
+    
+    finally:
+        shutdown()
+
+# 起動時間の計測
+def check_startup_time():
+    """新しいPythonプロセスで agent モジュールの読み込み時間を計測し、目標以内ならTrueを返す"""
+    import subprocess
+    code = ("import time; started = time.perf_counter(); import agent; "
+            "print((time.perf_counter() - started) * 1000)")
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    )
+    elapsed_ms = float(result.stdout.strip().splitlines()[-1])
+    within_budget = elapsed_ms <= startup_budget_ms
+    print(f"モジュール読み込み時間: {elapsed_ms:.1f}ms (目標 {startup_budget_ms:.0f}ms) "
+          + ("OK" if within_budget else "目標超過"))
+    return within_budget
+
+# 事前初期化
+def warm_up():
+    """Weaviate接続・コレクション・LLM・エージェントをまとめて初期化する（常駐サーバー用）"""
+    get_patent_collection()
+    get_agent_executor()
+    get_streaming_agent_executor()
+    get_semantic_cache()
+
+# 終了処理
+def shutdown():
+    """キャッシュを保存してWeaviate接続を閉じる"""
+    # セマンティックキャッシュを保存する
+    if get_semantic_cache.is_initialized():
         try:
-            client.close()
+            get_semantic_cache().save()
+        except Exception as e:
+            print(f"セマンティックキャッシュの保存エラー: {e}")
+    
+    # Weaviate接続を閉じる（接続済みの場合のみ）
+    if get_client.is_initialized():
+        try:
+            get_client().close()
             print("Weaviate接続を閉じました。")
         except:
             pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--startup-time" in sys.argv[1:]:
+        sys.exit(0 if check_startup_time() else 1)
+    elif "--async" in sys.argv[1:]:
+        asyncio.run(amain())
+    elif "--reindex" in sys.argv[1:]:
+        # 使い方: python agent.py --reindex [--embedding-model モデル名] [--drop-old]
+        args = sys.argv[1:]
+        model = args[args.index("--embedding-model") + 1] if "--embedding-model" in args else None
+        try:
+            reindex_patent_collection(model, keep_old="--drop-old" not in args)
+        finally:
+            shutdown()
+    else:
+        main()
\ No newline at end of file
@@ -1,78 +1,409 @@
 import feedparser
 import requests
 import time
-import random
 import os
+import json
+import hashlib
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-query = "heat storage material"
-output_dir = "pdf"
-os.makedirs(output_dir, exist_ok=True)
+query = os.getenv('ARXIV_QUERY', "heat storage material")
+output_dir = os.getenv('ARXIV_OUTPUT_DIR', "pdf")
 
 BATCH_SIZE = 100
 BASE_URL = "http://export.arxiv.org/api/query"
 
-start = 0
-total_results = None
+# 進捗の保存先（中断しても次回は続きから再開する）
+CHECKPOINT_PATH = os.getenv('ARXIV_CHECKPOINT_PATH', os.path.join('.cache', 'arxiv_checkpoint.json'))
+# ダウンロード済みPDFの一覧（arXiv ID → ファイル名・サイズ・ハッシュ）
+MANIFEST_PATH = os.getenv('ARXIV_MANIFEST_PATH', os.path.join(output_dir, 'manifest.json'))
 
-while True:
-    url = f"{BASE_URL}?search_query=all:{query}&start={start}&max_results={BATCH_SIZE}"
-    print(f"\n🔍 Fetching: start={start}")
-    feed = feedparser.parse(url)
+# arXivの利用制限（3秒に1回、1接続まで）に合わせたリクエスト間隔
+# 既定ではAPI（メタデータ取得）もPDFのダウンロードも3秒に1回、ダウンロードは1接続で行う。
+# 許可を得ている場合などは ARXIV_DOWNLOAD_RATE / ARXIV_DOWNLOAD_BURST / ARXIV_DOWNLOAD_WORKERS で上げられる。
+API_RATE = float(os.getenv('ARXIV_API_RATE', str(1 / 3)))
+DOWNLOAD_RATE = float(os.getenv('ARXIV_DOWNLOAD_RATE', str(1 / 3)))
+DOWNLOAD_BURST = int(os.getenv('ARXIV_DOWNLOAD_BURST', '1'))
+DOWNLOAD_WORKERS = int(os.getenv('ARXIV_DOWNLOAD_WORKERS', '1'))
+MAX_ATTEMPTS = int(os.getenv('ARXIV_MAX_ATTEMPTS', '3'))  # 1件あたりのダウンロード試行回数
+REQUEST_TIMEOUT = 60  # 秒
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # PDFは1MBずつファイルに書き込む
 
-    # 最初の1回だけトータル件数取得
-    if total_results is None:
-        total_results = int(feed.feed.opensearch_totalresults)
-        print(f"📚 Total results: {total_results}")
 
-    if not feed.entries:
-        print("✅ No more entries found. Done.")
-        break
+def write_json_atomic(path, data):
+    """一時ファイルに書き込んでから置き換える（書き込み中に中断しても壊れない）"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
 
-    for i, entry in enumerate(feed.entries):
+
+class TokenBucket:
+    """トークンバケットでリクエストの間隔を制御する
+
+    rate 回/秒のペースでトークンが貯まり（最大 capacity 個）、
+    acquire() はトークンが1つ取れるまで待つ。複数スレッドから共有できる。
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class HarvestCheckpoint:
+    """検索クエリごとの進捗（次のstartと各論文の状態）をJSONファイルに保存する
+
+    entries は arXiv ID → {"state": "pending" / "done" / "failed", "attempts": 試行回数, "meta": メタデータ}
+    """
+
+    def __init__(self, path, query):
+        self.path = path
+        self.query = query
+        self.next_start = 0
+        self.total_results = None
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
         try:
-            title = entry.title.strip()
-            authors = [author['name'] for author in entry.authors]
-            date = entry.published
-            dt = datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
-            year = dt.year
-            link = entry.links[0].href
-            pdf_url = entry.links[1].href
-
-            meta_json = {
-                "title": title,
-                "authors": authors,
-                "link": link,
-                "update_date": date,
-                "file_name": file_name,
-            }
-            now = datetime.now()
-            print(now)
-            print(f"📥 Downloading: {meta_json['title']}")
-            
-
-            # ファイル名整形
-            file_name = title.replace(" ", "_").replace("\n", "").replace("/", "_")
-            file_path = os.path.join(output_dir, f"{file_name}.pdf")
-
-            
-
-            # PDFをダウンロード
-            response = requests.get(pdf_url)
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            
-            # スリープを入れる
-            time.sleep(random.uniform(1.5, 3.5))
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ チェックポイントを読み込めませんでした（最初から取得します）: {e}")
+            return
+        if data.get("query") != self.query:
+            print("⚠️ チェックポイントの検索クエリが異なるため、最初から取得します")
+            return
+        self.next_start = data.get("next_start", 0)
+        self.total_results = data.get("total_results")
+        self.entries = data.get("entries", {})
+
+    def save(self):
+        with self._lock:
+            write_json_atomic(self.path, {
+                "query": self.query,
+                "next_start": self.next_start,
+                "total_results": self.total_results,
+                "entries": self.entries,
+            })
+
+    def add_entry(self, arxiv_id, meta):
+        """新しい論文を pending として登録する。登録済みならFalseを返す"""
+        with self._lock:
+            if arxiv_id in self.entries:
+                return False
+            self.entries[arxiv_id] = {"state": "pending", "attempts": 0, "meta": meta}
+            return True
+
+    def set_state(self, arxiv_id, state, error=None):
+        with self._lock:
+            entry = self.entries[arxiv_id]
+            entry["state"] = state
+            if state != "pending":
+                entry["attempts"] += 1
+            if error is not None:
+                entry["error"] = error
+            else:
+                entry.pop("error", None)
+
+    def unfinished(self, max_attempts=MAX_ATTEMPTS):
+        """ダウンロードが終わっていない（再試行できる）論文のIDを返す"""
+        with self._lock:
+            return [
+                arxiv_id for arxiv_id, entry in self.entries.items()
+                if entry["state"] != "done" and entry["attempts"] < max_attempts
+            ]
+
+    def counts(self):
+        with self._lock:
+            counts = {}
+            for entry in self.entries.values():
+                counts[entry["state"]] = counts.get(entry["state"], 0) + 1
+            return counts
+
+
+class PdfManifest:
+    """ダウンロード済みPDFの一覧。検索クエリをまたいで共有する
+
+    files は arXiv ID → {"file_name": ファイル名, "size": バイト数, "sha256": ハッシュ}
+    """
+
+    def __init__(self, path, output_dir):
+        self.path = path
+        self.output_dir = output_dir
+        self.files = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.files = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ マニフェストを読み込めませんでした: {e}")
+
+    def file_path(self, file_name):
+        return os.path.join(self.output_dir, f"{file_name}.pdf")
+
+    def is_present(self, arxiv_id, file_name=None):
+        """ダウンロード済みで、ファイルのサイズも一致していればTrueを返す
+
+        マニフェストにない論文でも、file_name のPDFがすでにあれば（以前の実行でダウンロードしたもの）
+        サイズとハッシュをマニフェストに追加してTrueを返す。
+        """
+        with self._lock:
+            record = self.files.get(arxiv_id)
+        if record is None:
+            return file_name is not None and self._backfill(arxiv_id, file_name)
+        try:
+            return os.path.getsize(self.file_path(record["file_name"])) == record["size"]
+        except OSError:
+            return False
+
+    def _backfill(self, arxiv_id, file_name):
+        """ディスク上のPDFをマニフェストに登録する（空のファイルやPDFでないファイルは登録しない）"""
+        file_path = self.file_path(file_name)
+        try:
+            size = os.path.getsize(file_path)
+            if size == 0:
+                return False
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                if f.read(5) != b'%PDF-':
+                    return False
+                f.seek(0)
+                for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(block)
+        except OSError:
+            return False
+        self.add(arxiv_id, file_name, size, digest.hexdigest())
+        return True
+
+    def add(self, arxiv_id, file_name, size, sha256):
+        with self._lock:
+            self.files[arxiv_id] = {"file_name": file_name, "size": size, "sha256": sha256}
+
+    def save(self):
+        with self._lock:
+            write_json_atomic(self.path, self.files)
+
 
+def create_session(pool_size=DOWNLOAD_WORKERS):
+    """接続を使い回すHTTPセッションを作成する（一時的なエラーは自動で再試行する）"""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=3, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size + 1, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def make_file_name(title):
+    """タイトルからファイル名を作る"""
+    return title.replace(" ", "_").replace("\n", "").replace("/", "_")
+
+
+def parse_entry(entry):
+    """フィードのエントリから arXiv ID とメタデータを取り出す"""
+    arxiv_id = entry.id.split("/abs/")[-1]
+    title = " ".join(entry.title.split())
+    authors = [author['name'] for author in entry.authors]
+    date = entry.published
+    dt = datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ')
+    link = entry.links[0].href
+    pdf_url = next(
+        (l.href for l in entry.links if l.get("type") == "application/pdf" or l.get("title") == "pdf"),
+        entry.links[1].href,
+    )
+    file_name = make_file_name(title)
+
+    meta_json = {
+        "arxiv_id": arxiv_id,
+        "title": title,
+        "authors": authors,
+        "link": link,
+        "pdf_url": pdf_url,
+        "abstract": " ".join(entry.get("summary", "").split()),
+        "doi": entry.get("arxiv_doi", ""),
+        "journal": entry.get("arxiv_journal_ref", ""),
+        "update_date": date,
+        "year": dt.year,
+        "file_name": file_name,
+    }
+    return arxiv_id, meta_json
+
+
+def fetch_page(session, api_bucket, search_query, start):
+    """検索結果を1ページ分取得する"""
+    api_bucket.acquire()
+    params = {"search_query": f"all:{search_query}", "start": start, "max_results": BATCH_SIZE}
+    response = session.get(BASE_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return feedparser.parse(response.content)
+
+
+def download_pdf(session, download_bucket, manifest, meta_json):
+    """PDFをダウンロードする
+
+    レスポンスを少しずつ一時ファイルに書き込み（メモリに全体を載せない）、
+    完了後に名前を変更して、サイズとハッシュをマニフェストに記録する。
+    """
+    file_path = manifest.file_path(meta_json["file_name"])
+    tmp_path = f"{file_path}.part"
+    download_bucket.acquire()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with session.get(meta_json["pdf_url"], timeout=REQUEST_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    manifest.add(meta_json["arxiv_id"], meta_json["file_name"], size, digest.hexdigest())
+    return file_path
+
+
+def harvest(search_query=query, on_downloaded=None, stop_event=None):
+    """メタデータのページ取得とPDFのダウンロードを並行して実行する
+
+    ページ取得は呼び出し元スレッド、ダウンロードはスレッドプールで行い、
+    それぞれトークンバケットでarXivの利用制限内に抑える。
+    on_downloaded を指定すると、PDFが揃った論文ごとに on_downloaded(メタデータ, ファイルパス) を
+    呼び出し元スレッドで呼ぶ（前回までにダウンロード済みの論文も含む）。
+    stop_event がセットされると、次のページを取得せずに終了する。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = HarvestCheckpoint(CHECKPOINT_PATH, search_query)
+    manifest = PdfManifest(MANIFEST_PATH, output_dir)
+    session = create_session()
+    api_bucket = TokenBucket(API_RATE)
+    download_bucket = TokenBucket(DOWNLOAD_RATE, DOWNLOAD_BURST)
+    in_flight = {}
+    started = time.perf_counter()
+    downloaded = 0
+    skipped = 0
+
+    def notify(arxiv_id):
+        if on_downloaded is not None:
+            meta_json = checkpoint.entries[arxiv_id]["meta"]
+            on_downloaded(meta_json, manifest.file_path(meta_json["file_name"]))
+
+    def on_done(future):
+        nonlocal downloaded
+        arxiv_id = in_flight.pop(future)
+        try:
+            future.result()
         except Exception as e:
-            print(f"❌ Error downloading '{entry.title}': {e}")
+            title = checkpoint.entries[arxiv_id]["meta"]["title"]
+            print(f"❌ Error downloading '{title}': {e}")
+            checkpoint.set_state(arxiv_id, "failed", error=str(e))
+            return
+        checkpoint.set_state(arxiv_id, "done")
+        downloaded += 1
+        notify(arxiv_id)
+
+    def submit(executor, arxiv_id):
+        nonlocal skipped
+        # ダウンロード済みのPDFはリクエストせずに完了扱いにする
+        if manifest.is_present(arxiv_id, checkpoint.entries[arxiv_id]["meta"]["file_name"]):
+            checkpoint.set_state(arxiv_id, "done")
+            skipped += 1
+            notify(arxiv_id)
+            return
+        # 実行待ちがたまりすぎないよう、ワーカー数の2倍を超えたら完了を待つ
+        while len(in_flight) >= DOWNLOAD_WORKERS * 2:
+            finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in finished:
+                on_done(future)
+        meta_json = checkpoint.entries[arxiv_id]["meta"]
+        print(f"📥 Downloading: {meta_json['title']}")
+        in_flight[executor.submit(download_pdf, session, download_bucket, manifest, meta_json)] = arxiv_id
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        try:
+            # 前回までにダウンロード済みの論文を先に渡す
+            if on_downloaded is not None:
+                for arxiv_id, entry in list(checkpoint.entries.items()):
+                    if entry["state"] == "done" and manifest.is_present(arxiv_id, entry["meta"]["file_name"]):
+                        notify(arxiv_id)
+
+            # 前回の実行で終わらなかった論文から再開する
+            unfinished = checkpoint.unfinished()
+            if unfinished:
+                print(f"🔁 Resuming: {len(unfinished)} unfinished downloads, start={checkpoint.next_start}")
+            for arxiv_id in unfinished:
+                submit(executor, arxiv_id)
+
+            while checkpoint.total_results is None or checkpoint.next_start < checkpoint.total_results:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                print(f"\n🔍 Fetching: start={checkpoint.next_start}")
+                feed = fetch_page(session, api_bucket, search_query, checkpoint.next_start)
+
+                # 最初の1回だけトータル件数取得
+                if checkpoint.total_results is None:
+                    checkpoint.total_results = int(feed.feed.opensearch_totalresults)
+                    print(f"📚 Total results: {checkpoint.total_results}")
+
+                if not feed.entries:
+                    print("✅ No more entries found. Done.")
+                    break
+
+                new_ids = []
+                for entry in feed.entries:
+                    try:
+                        arxiv_id, meta_json = parse_entry(entry)
+                    except Exception as e:
+                        print(f"❌ Error parsing '{entry.get('title', '')}': {e}")
+                        continue
+                    if checkpoint.add_entry(arxiv_id, meta_json):
+                        new_ids.append(arxiv_id)
+
+                checkpoint.next_start += BATCH_SIZE
+                checkpoint.save()
+                for arxiv_id in new_ids:
+                    submit(executor, arxiv_id)
+                manifest.save()
+
+            for future in wait(list(in_flight)).done:
+                on_done(future)
+        finally:
+            checkpoint.save()
+            manifest.save()
+            session.close()
 
-    start += BATCH_SIZE
-    if start >= total_results:
-        print("✅ All documents processed.")
-        break
+    elapsed = time.perf_counter() - started
+    print(f"✅ All documents processed. {downloaded} PDFs downloaded, {skipped} skipped in {elapsed:.1f}s {checkpoint.counts()}")
 
-    # バッチごとに少し長めにスリープ
-    time.sleep(5)
 
+if __name__ == "__main__":
+    harvest()
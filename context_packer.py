@@ -0,0 +1,111 @@
+# LLMに渡す特許情報（コンテキスト）をトークン数の上限内に詰める
+import os
+import math
+
+# コンテキストの設定
+DEFAULT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '2000'))
+MIN_OVERLAP_CHARS = 20    # これより短い一致は重複とみなさない
+MAX_OVERLAP_CHARS = 400   # チャンク分割のchunk_overlap(200)より十分大きい値
+TRUNCATION_MARK = "…"
+
+
+def _is_cjk(char):
+    code = ord(char)
+    return (
+        0x3040 <= code <= 0x30FF      # ひらがな・カタカナ
+        or 0x3400 <= code <= 0x9FFF   # 漢字
+        or 0xF900 <= code <= 0xFAFF
+        or 0xFF00 <= code <= 0xFFEF   # 全角英数・記号
+    )
+
+
+def estimate_tokens(text):
+    """トークン数の概算を返す（日本語は1文字1トークン、それ以外は4文字1トークン）
+
+    llama3系のトークナイザーを読み込まずに、プロンプト長の上限管理に十分な精度で見積もる。
+    """
+    cjk = sum(1 for char in text if _is_cjk(char))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def merge_overlapping(previous, current, max_overlap=MAX_OVERLAP_CHARS):
+    """前のチャンクの末尾と次のチャンクの先頭の重複部分を1つにまとめて連結する"""
+    limit = min(max_overlap, len(previous), len(current))
+    for size in range(limit, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(current[:size]):
+            return previous + current[size:]
+    return previous + "\n" + current
+
+
+def merge_chunks(chunks):
+    """(チャンクID, テキスト) のリストを本文順に連結する
+
+    連続したチャンクは重複部分（chunk_overlap）を取り除いてつなぎ、
+    離れたチャンクの間は「...」で区切る。
+    """
+    merged = ""
+    previous_id = None
+    for chunk_id, text in sorted(chunks, key=lambda chunk: chunk[0] or 0):
+        if not merged:
+            merged = text
+        elif previous_id is not None and chunk_id == previous_id + 1:
+            merged = merge_overlapping(merged, text)
+        else:
+            merged += "\n...\n" + text
+        previous_id = chunk_id
+    return merged
+
+
+def truncate_to_tokens(text, budget, count=estimate_tokens):
+    """テキストを budget トークン以内に切り詰める"""
+    if count(text) <= budget:
+        return text
+    # 二分探索で収まる最大の長さを求める
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count(text[:middle]) + 1 <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + TRUNCATION_MARK if low else ""
+
+
+def format_document(doc):
+    """特許番号・タイトル付きのコンテキスト文字列にする"""
+    metadata = doc.metadata
+    header = f"【特許番号: {metadata.get('patent_number') or 'N/A'}】{metadata.get('title') or ''}".rstrip()
+    return f"{header}\n{doc.page_content}"
+
+
+def pack_documents(docs, budget=DEFAULT_TOKEN_BUDGET, count=estimate_tokens, min_tokens=100):
+    """関連度順のDocumentを、見出しを含めて budget トークン以内に収まるだけ返す
+
+    同じ内容のDocumentは1回だけ使い、上限を超える最後のDocumentは
+    残りが min_tokens 以上あれば切り詰めて含める。
+    """
+    from langchain_core.documents import Document
+    packed = []
+    seen = set()
+    remaining = budget
+    for doc in docs:
+        if doc.page_content in seen:
+            continue
+        seen.add(doc.page_content)
+        header_tokens = count(format_document(doc)) - count(doc.page_content)
+        content_budget = remaining - header_tokens
+        if count(doc.page_content) <= content_budget:
+            packed.append(doc)
+            # Document間の区切り（空行）の分も差し引く
+            remaining -= count(format_document(doc)) + 1
+            continue
+        if content_budget >= min_tokens:
+            content = truncate_to_tokens(doc.page_content, content_budget, count)
+            packed.append(Document(page_content=content, metadata=doc.metadata))
+        break
+    return packed
+
+
+def pack_context(docs, budget=DEFAULT_TOKEN_BUDGET, count=estimate_tokens):
+    """pack_documents の結果をプロンプトに埋め込む文字列にする"""
+    return "\n\n".join(format_document(doc) for doc in pack_documents(docs, budget, count))
@@ -0,0 +1,173 @@
+# embeddingの永続キャッシュ（agent.py / llamaindex.py 共通）
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+# キャッシュの設定
+DEFAULT_CACHE_PATH = os.getenv('EMBED_CACHE_PATH', '.cache/embeddings.sqlite3')
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv('EMBED_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))  # 既定2GB
+
+
+def text_hash(text):
+    """チャンクテキストのハッシュ値を返す"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """(embeddingモデル名, テキストのハッシュ) をキーにしたSQLiteのembeddingキャッシュ
+
+    ベクトルはfloat32のBLOBとして保存し、合計サイズが max_bytes を超えたら
+    最終参照時刻の古いものから削除する（LRU）。
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # インポート時はスレッドプールから呼ばれるため、接続はロックで保護して共有する
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, model, texts):
+        """テキストのリストに対応するベクトルを返す（未登録はNone）"""
+        keys = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLiteの変数上限を超えないよう分割して検索する
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *part]
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, key) for key in found]
+                )
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, model, texts, vectors):
+        """ベクトルをキャッシュに保存する"""
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array('f', vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            for row in rows:
+                previous = self._conn.execute(
+                    "SELECT LENGTH(vector) FROM embeddings WHERE model = ? AND text_hash = ?",
+                    row[:2]
+                ).fetchone()
+                if previous:
+                    self._total_bytes -= previous[0]
+                self._total_bytes += len(row[2])
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # 上限を超えた分だけ古い順に削除する
+        while self._total_bytes > self.max_bytes:
+            victims = self._conn.execute(
+                "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not victims:
+                self._total_bytes = 0
+                break
+            removed = []
+            for rowid, size in victims:
+                removed.append((rowid,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE rowid = ?", removed)
+
+    def get_or_compute(self, model, texts, compute):
+        """キャッシュにないテキストだけ compute(texts) でembeddingし、結果を保存して返す"""
+        vectors = self.get_many(model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # 同じテキストが複数回含まれていても1回だけ計算する
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            computed = compute(unique_texts)
+            self.put_many(model, unique_texts, computed)
+            by_text = dict(zip(unique_texts, computed))
+            for i in missing:
+                vectors[i] = list(by_text[texts[i]])
+        return vectors
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を返す"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": self._total_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings:
+    """LangChainのEmbeddings（OllamaEmbeddingsなど）をキャッシュ付きでラップする"""
+
+    def __init__(self, embeddings, cache, model_name=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name or getattr(embeddings, 'model', type(embeddings).__name__)
+
+    def embed_documents(self, texts):
+        return self.cache.get_or_compute(self.model_name, list(texts), self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self.cache.get_or_compute(
+            self.model_name, [text], lambda texts: [self.embeddings.embed_query(texts[0])]
+        )[0]
+
+    async def aembed_documents(self, texts):
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text):
+        return await asyncio.to_thread(self.embed_query, text)
@@ -0,0 +1,234 @@
+# ベクトルインデックスの設定プロファイル（agent.py の Patent / weaviate_control.py の Scholar* 共通）
+# コレクション作成時に INDEX_PROFILE（または引数）で指定したプロファイルを適用する。
+#
+# ベンチマーク: python index_profiles.py --collection Patent [--profiles low-latency,high-recall] [--k 10]
+#   既存コレクションのベクトルをプロファイルごとの一時コレクションにコピーし、
+#   総当たり検索に対する recall@k と検索レイテンシ（p50/p99）を表示する。
+import os
+import math
+import time
+import argparse
+
+DEFAULT_INDEX_PROFILE = os.getenv('INDEX_PROFILE', 'default')
+
+# type: hnsw / flat、quantizer: None / pq / bq
+INDEX_PROFILES = {
+    # Weaviateの既定値
+    "default": None,
+    # 探索範囲を狭くして応答を速くする
+    "low-latency": {"type": "hnsw", "ef": 64, "ef_construction": 128, "max_connections": 16, "quantizer": None},
+    # 探索範囲とグラフの次数を広げて取りこぼしを減らす（インデックス作成は遅くなる）
+    "high-recall": {"type": "hnsw", "ef": 256, "ef_construction": 512, "max_connections": 64, "quantizer": None},
+    # 直積量子化（PQ）でメモリ上のベクトルを圧縮する
+    "memory-saving": {"type": "hnsw", "ef": 128, "ef_construction": 128, "max_connections": 16, "quantizer": "pq"},
+    # 小さなコレクション向け：グラフを作らず、バイナリ量子化（BQ）で全件を走査する
+    "small-flat": {"type": "flat", "quantizer": "bq"},
+}
+PQ_TRAINING_LIMIT = int(os.getenv('PQ_TRAINING_LIMIT', '100000'))
+
+
+def vector_index_config(profile=None, training_limit=None):
+    """プロファイル名からWeaviateのベクトルインデックス設定を返す（default の場合はNone）
+
+    PQは training_limit 件（省略時は PQ_TRAINING_LIMIT）のベクトルが登録された時点で学習・圧縮される。
+    """
+    profile = profile or DEFAULT_INDEX_PROFILE
+    if profile not in INDEX_PROFILES:
+        raise ValueError(f"不明なインデックスプロファイルです: {profile}（{', '.join(INDEX_PROFILES)}）")
+    settings = INDEX_PROFILES[profile]
+    if settings is None:
+        return None
+
+    from weaviate.classes.config import Configure
+    quantizer = None
+    if settings["quantizer"] == "pq":
+        quantizer = Configure.VectorIndex.Quantizer.pq(training_limit=training_limit or PQ_TRAINING_LIMIT)
+    elif settings["quantizer"] == "bq":
+        quantizer = Configure.VectorIndex.Quantizer.bq(cache=True)
+
+    if settings["type"] == "flat":
+        return Configure.VectorIndex.flat(quantizer=quantizer)
+    return Configure.VectorIndex.hnsw(
+        ef=settings["ef"],
+        ef_construction=settings["ef_construction"],
+        max_connections=settings["max_connections"],
+        quantizer=quantizer
+    )
+
+
+# 既存コレクションに後から適用できる圧縮方式（WeaviateHandler.enable_compression で使う）
+COMPRESSION_METHODS = ("pq", "bq", "sq")
+
+
+def default_pq_segments(dimensions):
+    """PQのセグメント数（1セグメント = 4次元）"""
+    return dimensions // 4 if dimensions % 4 == 0 else dimensions
+
+
+def estimate_vector_memory(count, dimensions, method=None, segments=None):
+    """ベクトルがメモリ上で占めるバイト数の概算を返す（HNSWグラフの分は含まない）
+
+    圧縮なしはfloat32、PQは1セグメント1バイト＋コードブック、BQは1次元1ビット、SQは1次元1バイト。
+    """
+    if method is None:
+        return count * dimensions * 4
+    if method == "pq":
+        segments = segments or default_pq_segments(dimensions)
+        return count * segments + 256 * dimensions * 4
+    if method == "bq":
+        return count * math.ceil(dimensions / 8)
+    if method == "sq":
+        return count * dimensions
+    raise ValueError(f"不明な圧縮方式です: {method}（{', '.join(COMPRESSION_METHODS)}）")
+
+
+def reconfigure_quantizer(method, segments=None):
+    """既存のHNSWインデックスに適用する圧縮設定を返す"""
+    from weaviate.classes.config import Reconfigure
+    if method == "pq":
+        return Reconfigure.VectorIndex.Quantizer.pq(segments=segments, training_limit=PQ_TRAINING_LIMIT)
+    if method == "bq":
+        return Reconfigure.VectorIndex.Quantizer.bq()
+    if method == "sq":
+        return Reconfigure.VectorIndex.Quantizer.sq(training_limit=PQ_TRAINING_LIMIT)
+    raise ValueError(f"不明な圧縮方式です: {method}（{', '.join(COMPRESSION_METHODS)}）")
+
+
+def wait_for_compression(client, collection_name, timeout=600):
+    """全シャードの圧縮とインデックス作成が終わるまで待つ（timeout 秒以内に終わらなければFalse）"""
+    deadline = time.monotonic() + timeout
+    while True:
+        nodes = client.cluster.nodes(collection=collection_name, output="verbose")
+        shards = [shard for node in nodes for shard in (node.shards or [])]
+        if shards and all(
+            shard.compressed and shard.vector_indexing_status == "READY" and shard.vector_queue_length == 0
+            for shard in shards
+        ):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(2)
+
+
+def export_vectors(collection, vector_name="default", limit=20000):
+    """コレクションのベクトルを最大 limit 件まで読み出してfloat32の行列で返す"""
+    import numpy as np
+    vectors = []
+    for obj in collection.iterator(include_vector=True, return_properties=[]):
+        vector = obj.vector.get(vector_name) if isinstance(obj.vector, dict) else obj.vector
+        if vector:
+            vectors.append(vector)
+        if len(vectors) >= limit:
+            break
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def brute_force_top_k(corpus, queries, k):
+    """コサイン類似度の総当たりで、各クエリの上位k件の行番号を返す"""
+    import numpy as np
+    corpus = corpus / np.maximum(np.linalg.norm(corpus, axis=1, keepdims=True), 1e-12)
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, min(k, corpus.shape[0] - 1), axis=1)[:, :k]
+    return [set(row.tolist()) for row in top]
+
+
+def split_held_out(vectors, query_count, seed=0):
+    """ベクトルを、インデックスに入れる集合と検索に使う集合（held-out）に分ける"""
+    import numpy as np
+    order = np.random.default_rng(seed).permutation(len(vectors))
+    query_count = min(query_count, len(vectors) // 2)
+    return vectors[order[query_count:]], vectors[order[:query_count]]
+
+
+def measure_queries(collection, queries, truth, k):
+    """near_vector検索を実行し、(recall@k, レイテンシ(ミリ秒)のリスト) を返す"""
+    import numpy as np
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        response = collection.query.near_vector(near_vector=query.tolist(), limit=k, return_properties=["row"])
+        latencies.append((time.perf_counter() - started) * 1000)
+        found = {obj.properties["row"] for obj in response.objects}
+        recalls.append(len(found & expected) / max(1, len(expected)))
+    return float(np.mean(recalls)), latencies
+
+
+def benchmark_profile(client, profile, corpus, queries, truth, k, keep=False):
+    """プロファイルを適用した一時コレクションにベクトルを登録して検索性能を測る
+
+    PQのプロファイルは登録するベクトル数で学習させ、圧縮が終わってから測る。
+    """
+    import numpy as np
+    from weaviate.classes.config import Configure, Property, DataType
+    name = "IndexBench_" + profile.replace("-", "_")
+    if client.collections.exists(name):
+        client.collections.delete(name)
+    uses_pq = (INDEX_PROFILES[profile] or {}).get("quantizer") == "pq"
+    collection = client.collections.create(
+        name=name,
+        properties=[Property(name="row", data_type=DataType.INT)],
+        vectorizer_config=Configure.Vectorizer.none(),
+        # PQ_TRAINING_LIMIT より少ないベクトルでは学習されず、圧縮なしの結果になってしまう
+        vector_index_config=vector_index_config(profile, training_limit=min(PQ_TRAINING_LIMIT, len(corpus)))
+    )
+    try:
+        started = time.perf_counter()
+        with collection.batch.fixed_size(batch_size=500) as batch:
+            for row, vector in enumerate(corpus):
+                batch.add_object(properties={"row": row}, vector=vector.tolist())
+        if collection.batch.failed_objects:
+            print(f"{profile}: {len(collection.batch.failed_objects)}件の登録に失敗しました")
+        if uses_pq and not wait_for_compression(client, name):
+            raise RuntimeError(f"{profile}: PQの圧縮が終わらなかったため測定を中止しました")
+        build_seconds = time.perf_counter() - started
+
+        recall, latencies = measure_queries(collection, queries, truth, k)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        return {"profile": profile, "recall": recall, "p50_ms": p50, "p99_ms": p99, "build_seconds": build_seconds}
+    finally:
+        if not keep:
+            client.collections.delete(name)
+
+
+def run_benchmark(client, collection_name, profiles, k=10, query_count=200, limit=20000, vector_name="default", keep=False):
+    """既存コレクションのベクトルで各プロファイルを比較し、結果のリストを返す"""
+    vectors = export_vectors(client.collections.get(collection_name), vector_name, limit)
+    if len(vectors) < 2:
+        print(f"コレクション '{collection_name}' にベクトルがありません")
+        return []
+    corpus, queries = split_held_out(vectors, query_count)
+    truth = brute_force_top_k(corpus, queries, k)
+    print(f"{collection_name}: {len(corpus)}件 × {corpus.shape[1]}次元, クエリ {len(queries)}件, k={k}")
+
+    results = []
+    for profile in profiles:
+        result = benchmark_profile(client, profile, corpus, queries, truth, k, keep)
+        results.append(result)
+        print(f"{profile:>14}: recall@{k} {result['recall']:.3f}  p50 {result['p50_ms']:.1f}ms  "
+              f"p99 {result['p99_ms']:.1f}ms  (登録 {result['build_seconds']:.1f}秒)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクトルインデックスのプロファイルを比較する")
+    parser.add_argument("--collection", default="Patent")
+    parser.add_argument("--profiles", default=",".join(INDEX_PROFILES), help="カンマ区切りのプロファイル名")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="held-outクエリの件数")
+    parser.add_argument("--limit", type=int, default=20000, help="読み出すベクトルの最大件数")
+    parser.add_argument("--vector-name", default="default", help="名前付きベクトルの名前（Scholar*は general_vector）")
+    parser.add_argument("--keep", action="store_true", help="一時コレクションを削除しない")
+    args = parser.parse_args()
+
+    import weaviate
+    profiles = [profile.strip() for profile in args.profiles.split(",") if profile.strip()]
+    for profile in profiles:
+        vector_index_config(profile)  # 不明なプロファイル名はここでエラーにする
+    with weaviate.connect_to_local() as client:
+        run_benchmark(client, args.collection, profiles, args.k, args.queries, args.limit, args.vector_name, args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,70 @@
+import sys
 import weaviate
 import requests
 from typing import Any, List
 from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.readers.file import PyMuPDFReader
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.vector_stores.weaviate import WeaviateVectorStore
 from llama_index.core import VectorStoreIndex, StorageContext, Document
+from pydantic import PrivateAttr
+from embedding_cache import EmbeddingCache
+from pdf_extract import PdfExtractor
 
 # --- Step 1: Ollama Embedding 定義 ---
-# Ollama埋め込みモデルの設定
-embed_model = OllamaEmbedding(model_name="dengcao/Qwen3-Embedding-0.6B:F16", base_url="http://localhost:11434")
-
-# --- Step 2: Weaviate クライアントと埋め込み設定 ---
-client = weaviate.connect_to_local()
-
-embedding = OllamaEmbedding(api_url="http://localhost:11434", model_name="dengcao/Qwen3-Embedding-0.6B:F16")
-vector_store = WeaviateVectorStore(
-    weaviate_client=client,
-    embedding=embedding,
-    index_name="OllamaPDFIndex",
-    text_key="content"
-)
-storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-# --- Step 3: PDF 読み込みとチャンク分割 ---
-reader = PyMuPDFReader()
-documents: List[Document] = reader.load(file_path="./pdf/sample.pdf")
-
-# Sentenceベースのチャンク（長さと重複は調整可能）
-parser = SentenceSplitter(chunk_size=512, chunk_overlap=50)
-nodes = parser.get_nodes_from_documents(documents)
-
-# --- Step 4: チャンクを Weaviate に格納 ---
-index = VectorStoreIndex(nodes, storage_context=storage_context,embed_model=embedding)
+class CachedOllamaEmbedding(OllamaEmbedding):
+    """変更のないチャンクはembeddingキャッシュから返すOllamaEmbedding"""
+
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, cache: EmbeddingCache, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._cache = cache
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cache.get_or_compute(self.model_name, texts, super()._get_text_embeddings)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._cache.get_or_compute(
+            self.model_name, [query], lambda texts: [super(CachedOllamaEmbedding, self)._get_query_embedding(texts[0])]
+        )[0]
+
+# プロセスプールのワーカーでは実行しないよう、処理は __main__ のときだけ行う
+if __name__ == "__main__":
+    # Ollama埋め込みモデルの設定（agent.pyと同じキャッシュファイルを共有）
+    embedding_cache = EmbeddingCache()
+    embed_model = CachedOllamaEmbedding(embedding_cache, model_name="dengcao/Qwen3-Embedding-0.6B:F16", base_url="http://localhost:11434")
+
+    # --- Step 2: Weaviate クライアントと埋め込み設定 ---
+    client = weaviate.connect_to_local()
+
+    embedding = embed_model
+    vector_store = WeaviateVectorStore(
+        weaviate_client=client,
+        embedding=embedding,
+        index_name="OllamaPDFIndex",
+        text_key="content"
+    )
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+
+    # --- Step 3: PDF 読み込みとチャンク分割 ---
+    # ページ範囲ごとにプロセスプールで変換し、変換済みのページはキャッシュから読み込む
+    with PdfExtractor() as extractor:
+        documents: List[Document] = [
+            Document(text=page["text"], metadata={"file_path": page["path"], "page": page["page"], "section": page["section"]})
+            for page in extractor.iter_pages(sys.argv[1:] or ["./pdf/sample.pdf"])
+        ]
+        print(f"PDFページキャッシュ: {extractor.cache.stats()}")
+
+    # Sentenceベースのチャンク（長さと重複は調整可能）
+    parser = SentenceSplitter(chunk_size=512, chunk_overlap=50)
+    nodes = parser.get_nodes_from_documents(documents)
+
+    # --- Step 4: チャンクを Weaviate に格納 ---
+    index = VectorStoreIndex(nodes, storage_context=storage_context,embed_model=embedding)
+    print(f"embeddingキャッシュ: {embedding_cache.stats()}")
 
 
 # ToDo
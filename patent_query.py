@@ -0,0 +1,261 @@
+# 質問文の解析（特許番号・出願番号・分類コード・絞り込み条件の抽出）
+import re
+import unicodedata
+from datetime import datetime, timezone
+
+# 特許番号・公開番号（例: 特許第6543210号, 特開2020-123456, JP2020123456A, US10,123,456B2）
+PATENT_NUMBER_PATTERNS = [
+    re.compile(r'特許第?\s*(\d{6,8})\s*号?'),
+    re.compile(r'((?:特開|特表|再表|特公|実開|実登)\s*(?:\d{4}|[SHR]\d{1,2})\s*-\s*\d{4,7})'),
+    re.compile(r'(?<![A-Za-z0-9])((?:JP|US|EP|WO|CN|KR|DE)\s?\d[\d,/-]{4,}\s?[A-Z]?\d?)(?![A-Za-z0-9])'),
+]
+
+# 出願番号（例: 特願2019-123456, 実願2019-001234）
+APPLICATION_NUMBER_PATTERNS = [
+    re.compile(r'((?:特願|実願)\s*(?:\d{4}|[SHR]\d{1,2})\s*-\s*\d{4,7})'),
+]
+
+# 特許分類コード（IPC/CPC/FI。例: G06N 3/08, H04L9/32, G06F16/00）
+CLASSIFICATION_PATTERN = re.compile(r'(?<![A-Za-z0-9])([A-H]\d{2}[A-Z])\s?(\d{1,4}/\d{2,6})(?![A-Za-z0-9])')
+
+# 識別子を除いた残りがこれらの語だけなら「識別子での検索」とみなす
+LOOKUP_FILLER_PATTERN = re.compile(
+    r'特許|番号|出願|公報|分類|コード|検索|調べ|教えて|探して|について|に関する|の|を|は|て|下さい|ください|内容|情報|詳細|概要|[、。,.?？!！\s]'
+)
+
+
+def _normalize(text):
+    """全角英数字・記号を半角にそろえる"""
+    return unicodedata.normalize('NFKC', text)
+
+
+def _compact(identifier):
+    """識別子から空白とカンマを取り除く"""
+    return re.sub(r'[\s,]', '', identifier)
+
+
+def normalize_number(number):
+    """特許番号・出願番号を照合用の形（半角・空白とカンマなし・大文字）にそろえる"""
+    return _compact(_normalize(number)).upper()
+
+
+def _stored_number(value, patterns):
+    """登録する特許番号・出願番号を、質問文からの抽出と同じパターンで照合用の形にする
+
+    "特許第6543210号" は質問側と同じく "6543210" になる。どのパターンにも一致しなければ値全体を使う。
+    """
+    text = _normalize(value or '')
+    for pattern in patterns:
+        match = pattern.search(text)
+        if match:
+            return normalize_number(match.group(1))
+    return normalize_number(text)
+
+
+def build_identifier_keys(patent_number, application_number, classification_codes):
+    """特許の番号・分類コードから、extract_identifiers の結果と完全一致で照合できるキーを作成する"""
+    return {
+        "patent_number_key": _stored_number(patent_number, PATENT_NUMBER_PATTERNS),
+        "application_number_key": _stored_number(application_number, APPLICATION_NUMBER_PATTERNS),
+        "classification_keys": [normalize_classification_code(code) for code in classification_codes or []],
+    }
+
+
+def normalize_classification_code(code):
+    """分類コードを照合用の形（例: G06N 3/08）にそろえる"""
+    text = _compact(_normalize(code)).upper()
+    match = CLASSIFICATION_PATTERN.fullmatch(text)
+    return f"{match.group(1)} {match.group(2)}" if match else text
+
+
+def extract_identifiers(query):
+    """質問文から特許番号・出願番号・分類コードを抽出する
+
+    戻り値の lookup_only は、質問が特許番号・出願番号と補助的な語だけでできている
+    （ベクトル検索が不要な）場合にTrueになる。分類コードは多数の特許に一致するため、
+    分類コードだけの質問はランキングのために検索を行う。
+    """
+    text = _normalize(query)
+    remainder = text
+    patent_numbers = []
+    application_numbers = []
+    classification_codes = []
+
+    for pattern in APPLICATION_NUMBER_PATTERNS:
+        for match in pattern.finditer(text):
+            application_numbers.append(normalize_number(match.group(1)))
+            remainder = remainder.replace(match.group(0), ' ')
+    for pattern in PATENT_NUMBER_PATTERNS:
+        for match in pattern.finditer(remainder):
+            patent_numbers.append(normalize_number(match.group(1)))
+            remainder = remainder.replace(match.group(0), ' ')
+    for match in CLASSIFICATION_PATTERN.finditer(remainder):
+        classification_codes.append(f"{match.group(1)} {match.group(2)}")
+        remainder = remainder.replace(match.group(0), ' ')
+
+    found = bool(patent_numbers or application_numbers)
+    return {
+        "patent_numbers": list(dict.fromkeys(patent_numbers)),
+        "application_numbers": list(dict.fromkeys(application_numbers)),
+        "classification_codes": list(dict.fromkeys(classification_codes)),
+        "lookup_only": found and not LOOKUP_FILLER_PATTERN.sub('', remainder),
+    }
+
+
+def identifiers_key(identifiers):
+    """抽出した識別子をキャッシュのキーに変換する"""
+    return (
+        tuple(identifiers["patent_numbers"]),
+        tuple(identifiers["application_numbers"]),
+        tuple(identifiers["classification_codes"]),
+    )
+
+
+# 期間の指定（例: 2020年以降, 2018年から2020年, 2019年以前, 過去5年）
+YEAR_RANGE_PATTERN = re.compile(r'((?:19|20)\d{2})\s*年?\s*(?:から|〜|~|－|-)\s*((?:19|20)\d{2})\s*年(?:まで|の間)?')
+YEAR_SINCE_PATTERN = re.compile(r'((?:19|20)\d{2})\s*年\s*(?:以降|以後|以来|から)')
+YEAR_UNTIL_PATTERN = re.compile(r'((?:19|20)\d{2})\s*年\s*(以前|まで|より前)')
+YEAR_IN_PATTERN = re.compile(r'((?:19|20)\d{2})\s*年(?:度)?(?:の|に|に公開)')
+RECENT_YEARS_PATTERN = re.compile(r'(?:過去|直近|最近)\s*(\d{1,2})\s*年(?:間)?')
+
+# 特許分類のサブクラス（例: G06N, H04L）
+CLASSIFICATION_SUBCLASS_PATTERN = re.compile(r'(?<![A-Za-z0-9])([A-H]\d{2}[A-Z])(?![A-Za-z0-9/])')
+
+# 企業名の別名（質問での呼び方 → 特許権者名に含まれる語）
+ASSIGNEE_ALIASES = {
+    "トヨタ": ["トヨタ"],
+    "ホンダ": ["本田技研", "ホンダ"],
+    "日産": ["日産"],
+    "デンソー": ["デンソー"],
+    "ソニー": ["ソニー"],
+    "パナソニック": ["パナソニック"],
+    "日立": ["日立"],
+    "東芝": ["東芝"],
+    "三菱電機": ["三菱電機"],
+    "富士通": ["富士通"],
+    "NEC": ["日本電気", "NEC"],
+    "キヤノン": ["キヤノン"],
+    "キャノン": ["キヤノン"],
+    "シャープ": ["シャープ"],
+    "富士フイルム": ["富士フイルム"],
+    "リコー": ["リコー"],
+    "京セラ": ["京セラ"],
+    "村田製作所": ["村田製作所"],
+    "NTT": ["日本電信電話", "NTT"],
+    "ソフトバンク": ["ソフトバンク"],
+    "Google": ["Google"],
+    "グーグル": ["Google", "グーグル"],
+    "Apple": ["Apple"],
+    "アップル": ["Apple", "アップル"],
+    "IBM": ["International Business Machines", "IBM"],
+    "Microsoft": ["Microsoft"],
+    "マイクロソフト": ["Microsoft", "マイクロソフト"],
+    "Samsung": ["Samsung"],
+    "サムスン": ["Samsung", "三星"],
+}
+
+# 「〜株式会社」「〜社の」などの形の企業名
+ASSIGNEE_PATTERNS = [
+    re.compile(r'(?:株式会社|\(株\))\s*([A-Za-z0-9゠-ヿ一-鿿]{2,20})'),
+    re.compile(r'([A-Za-z0-9゠-ヿ一-鿿]{2,20}?)\s*(?:株式会社|\(株\))'),
+    re.compile(r'([A-Za-z゠-ヿ一-鿿]{2,15}?)社(?:の|が|による|製)'),
+]
+ASSIGNEE_STOPWORDS = {"各", "他", "自", "当", "御", "弊", "貴", "同", "会", "企業", "競合", "大手"}
+
+# 条件を取り除いた残りがこれらの語だけなら、検索用の文字列には元の質問を使う
+SEARCH_FILLER_PATTERN = re.compile(
+    r'特許|出願|公報|検索|調べ|教えて|探して|について|に関する|下さい|ください|'
+    r'の|を|は|が|に|で|と|や|も|て|[、。,.?？!！・\s]'
+)
+
+
+def _year_start(year):
+    return datetime(year, 1, 1, tzinfo=timezone.utc)
+
+
+def _year_end(year):
+    return datetime(year, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
+
+
+def extract_constraints(query, now=None):
+    """質問文から公開日・特許権者・分類コードの条件を抽出する
+
+    戻り値の text は条件を表す語句を取り除いた検索用の文字列。
+    取り除いた残りに内容を表す語がない場合（"の の特許" など）は元の質問をそのまま使う。
+    """
+    text = _normalize(query)
+    remainder = text
+    date_from = None
+    date_to = None
+    now = now or datetime.now(timezone.utc)
+
+    match = YEAR_RANGE_PATTERN.search(remainder)
+    if match:
+        first, last = sorted((int(match.group(1)), int(match.group(2))))
+        date_from, date_to = _year_start(first), _year_end(last)
+        remainder = remainder.replace(match.group(0), ' ')
+    else:
+        match = YEAR_SINCE_PATTERN.search(remainder)
+        if match:
+            date_from = _year_start(int(match.group(1)))
+            remainder = remainder.replace(match.group(0), ' ')
+        match = YEAR_UNTIL_PATTERN.search(remainder)
+        if match:
+            year = int(match.group(1))
+            date_to = _year_end(year - 1 if match.group(2) == "より前" else year)
+            remainder = remainder.replace(match.group(0), ' ')
+        if date_from is None and date_to is None:
+            match = YEAR_IN_PATTERN.search(remainder)
+            if match:
+                year = int(match.group(1))
+                date_from, date_to = _year_start(year), _year_end(year)
+                remainder = remainder.replace(match.group(0), ' ')
+    if date_from is None:
+        match = RECENT_YEARS_PATTERN.search(remainder)
+        if match:
+            date_from = _year_start(now.year - int(match.group(1)) + 1)
+            remainder = remainder.replace(match.group(0), ' ')
+
+    assignees = []
+    for alias, names in ASSIGNEE_ALIASES.items():
+        # 英字の別名は単語の一部（例: CONNECT の NEC）に一致させない
+        # 「株式会社」「(株)」「社」も一緒に取り除く（例: 株式会社デンソーの → の）
+        alias_pattern = re.compile(
+            rf'(?:株式会社\s*|\(株\)\s*)?(?<![A-Za-z]){re.escape(alias)}(?![A-Za-z])'
+            rf'(?:\s*株式会社|\s*\(株\)|社(?=の|が|による|製))?'
+        )
+        if alias_pattern.search(remainder):
+            assignees.extend(names)
+            remainder = alias_pattern.sub(' ', remainder)
+    for pattern in ASSIGNEE_PATTERNS:
+        for match in pattern.finditer(remainder):
+            name = match.group(1)
+            if name not in ASSIGNEE_STOPWORDS:
+                assignees.append(name)
+                remainder = remainder.replace(match.group(0), ' ')
+
+    # 完全な分類コード（例: G06N 3/08）は extract_identifiers のフィルタで扱うため、
+    # サブクラスの条件にせず、コード全体を検索用の文字列から取り除く
+    remainder = CLASSIFICATION_PATTERN.sub(' ', remainder)
+    classification_prefixes = []
+    for match in CLASSIFICATION_SUBCLASS_PATTERN.finditer(remainder):
+        classification_prefixes.append(match.group(1))
+        remainder = remainder.replace(match.group(0), ' ')
+
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "assignees": list(dict.fromkeys(assignees)),
+        "classification_prefixes": list(dict.fromkeys(classification_prefixes)),
+        "text": " ".join(remainder.split()) if SEARCH_FILLER_PATTERN.sub('', remainder) else text,
+    }
+
+
+def constraints_key(constraints):
+    """抽出した条件をキャッシュのキーに変換する"""
+    return (
+        constraints["date_from"],
+        constraints["date_to"],
+        tuple(constraints["assignees"]),
+        tuple(constraints["classification_prefixes"]),
+    )
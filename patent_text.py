@@ -0,0 +1,57 @@
+# 特許テキストの組み立てと分割（インポート時にプロセスプールから呼ばれる）
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# チャンク分割の設定
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+SEPARATORS = ["\n\n", "\n", "。", "．", "!", "?", "！", "？", " ", ""]
+
+# ワーカープロセスごとに1つだけ作成する
+_text_splitter = None
+
+
+def get_text_splitter():
+    """チャンク分割用のスプリッターを返す"""
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            separators=SEPARATORS
+        )
+    return _text_splitter
+
+
+# 特許の主要部分をテキストとして結合する関数
+def build_patent_text(patent):
+    """特許データからembedding用の本文テキストを組み立てる"""
+    full_text = ""
+    if patent.get('title'):
+        full_text += f"タイトル: {patent['title']}\n\n"
+    if patent.get('abstract'):
+        full_text += f"概要: {patent['abstract']}\n\n"
+    if patent.get('claims'):
+        full_text += f"請求項: {patent['claims']}\n\n"
+
+    # 追加情報も含める
+    if patent.get('inventors'):
+        inventors = patent['inventors'] if isinstance(patent['inventors'], list) else [patent['inventors']]
+        full_text += f"発明者: {', '.join(inventors)}\n"
+    if patent.get('assignee'):
+        full_text += f"特許権者: {patent['assignee']}\n"
+    if patent.get('classification_codes'):
+        codes = patent['classification_codes'] if isinstance(patent['classification_codes'], list) else [patent['classification_codes']]
+        full_text += f"分類コード: {', '.join(codes)}\n"
+
+    return full_text
+
+
+def split_patent(patent):
+    """特許1件分の本文を組み立てて分割し、(本文, チャンクのリスト) を返す
+
+    本文が空の場合はチャンクのリストも空になる。
+    """
+    full_text = build_patent_text(patent)
+    if not full_text.strip():
+        return full_text, []
+    return full_text, get_text_splitter().split_text(full_text)
@@ -0,0 +1,299 @@
+# PDFのページ抽出（プロセスプールで並列化し、ページ単位でキャッシュする）
+# weaviate_control.py / scholar_pipeline.py / llamaindex.py 共通
+import os
+import queue
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+# 抽出の設定
+DEFAULT_CACHE_PATH = os.getenv('PDF_PAGE_CACHE_PATH', '.cache/pdf_pages.sqlite3')
+DEFAULT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '8'))  # 1回のワーカー呼び出しで変換するページ数
+HASH_READ_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """PDFファイルの内容のハッシュ値を返す"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_pages(path, pages):
+    """指定したページ（0始まり）をMarkdownに変換し、(ページ番号(1始まり), テキスト) のリストを返す
+
+    プロセスプールのワーカーで実行する。
+    """
+    import pymupdf4llm
+    md_chunks = pymupdf4llm.to_markdown(doc=path, pages=pages, page_chunks=True, show_progress=False)
+    return [(page + 1, chunk.get("text", "").strip()) for page, chunk in zip(pages, md_chunks)]
+
+
+def read_sections(path):
+    """目次（しおり）から各ページの見出しを求め、ページ数と見出しのリストを返す"""
+    import pymupdf
+    with pymupdf.open(path) as doc:
+        page_count = doc.page_count
+        toc = doc.get_toc(simple=True)
+    sections = [""] * page_count
+    for _, title, page in sorted(toc, key=lambda item: item[2]):
+        for i in range(max(page - 1, 0), page_count):
+            sections[i] = title
+    return page_count, sections
+
+
+class PdfPageCache:
+    """PDFのハッシュをキーにしたSQLiteのページキャッシュ
+
+    全ページを変換し終えたPDFは files に登録し、次回は変換せずに返す。
+    途中で中断したPDFは変換済みのページだけ再利用する。
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 読み込みスレッドと呼び出し元スレッドから使うため、接続はロックで保護して共有する
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                file_hash TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (file_hash, page)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_hash TEXT PRIMARY KEY,
+                page_count INTEGER NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def get_pages(self, key):
+        """変換済みのページを {ページ番号: テキスト} で返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page, text FROM pages WHERE file_hash = ?", (key,)
+            ).fetchall()
+        return dict(rows)
+
+    def is_complete(self, key):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM files WHERE file_hash = ?", (key,)
+            ).fetchone() is not None
+
+    def put_pages(self, key, pages):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pages (file_hash, page, text) VALUES (?, ?, ?)",
+                [(key, page, text) for page, text in pages]
+            )
+            self._conn.commit()
+
+    def mark_complete(self, key, page_count):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (file_hash, page_count) VALUES (?, ?)", (key, page_count)
+            )
+            self._conn.commit()
+
+    def stats(self):
+        """キャッシュから返したページ数・変換したページ数を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class PdfExtractor:
+    """複数のPDFをページ範囲に分けてプロセスプールで変換し、終わったページから順に返す
+
+    1つの大きなPDFも複数のワーカーで分担するため、コア数に比例して速くなる。
+    プロセスプールは最初の呼び出しで作成して使い回すため、使い終わったら close() を呼ぶ。
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, cache=None, pages_per_task=PAGES_PER_TASK, max_pending=None):
+        self.workers = max(1, workers)
+        # キャッシュを渡されなかった場合は close() で自分で閉じる
+        self._owns_cache = cache is None
+        self.cache = cache if cache is not None else PdfPageCache()
+        self.pages_per_task = max(1, pages_per_task)
+        # 結果を受け取り待ちのタスク数の上限（読み込みが先行しすぎないようにする）
+        self.max_pending = max_pending or self.workers * 4
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """プロセスプールを終了し、自分で開いたキャッシュを閉じる"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._owns_cache:
+            self.cache.close()
+            self._owns_cache = False
+
+    def _schedule(self, path, executor, results, slots, stop_event, files, futures):
+        """1つのPDFをキャッシュから返すか、ページ範囲ごとにプロセスプールへ投入する。投入した件数を返す"""
+        key = file_hash(path)
+        page_count, sections = read_sections(path)
+        cached = self.cache.get_pages(key)
+        if self.cache.is_complete(key):
+            missing = []
+        else:
+            missing = [page for page in range(page_count) if page + 1 not in cached]
+        tasks = [missing[i:i + self.pages_per_task] for i in range(0, len(missing), self.pages_per_task)]
+        # remaining はキャッシュ分とページ範囲ごとの結果のうち、まだ受け取っていない件数
+        remaining = len(tasks) + (1 if cached else 0)
+        files[path] = {"key": key, "page_count": page_count, "remaining": remaining, "failed": False}
+        if not tasks and not self.cache.is_complete(key):
+            self.cache.mark_complete(key, page_count)
+        if remaining == 0:
+            # ページがないPDFは返す結果がないため、完了だけを知らせる（件数には数えない）
+            results.put(("done", path))
+            return 0
+
+        scheduled = 0
+        if cached:
+            if not self._acquire(slots, stop_event):
+                return scheduled
+            results.put(("pages", path, sections, sorted(cached.items()), True))
+            scheduled += 1
+        for pages in tasks:
+            if not self._acquire(slots, stop_event):
+                return scheduled
+            future = executor.submit(extract_pages, path, pages)
+            futures.append(future)
+            future.add_done_callback(
+                lambda future, path=path, sections=sections: results.put(self._task_result(path, sections, future))
+            )
+            scheduled += 1
+        return scheduled
+
+    @staticmethod
+    def _task_result(path, sections, future):
+        try:
+            return ("pages", path, sections, future.result(), False)
+        except Exception as e:
+            return ("error", path, e)
+
+    @staticmethod
+    def _acquire(slots, stop_event):
+        while not stop_event.is_set():
+            if slots.acquire(timeout=0.5):
+                return True
+        return False
+
+    def _feed(self, paths, executor, results, slots, stop_event, files, futures):
+        """PDFを1つずつ読み込んで投入し、最後に投入した件数を知らせる"""
+        scheduled = 0
+        try:
+            for path in paths:
+                if stop_event.is_set():
+                    break
+                try:
+                    scheduled += self._schedule(path, executor, results, slots, stop_event, files, futures)
+                except Exception as e:
+                    print(f"PDFの読み込みエラー: {path} - {e}")
+        finally:
+            results.put(("end", scheduled))
+
+    def iter_pages(self, paths, on_file_done=None):
+        """PDFのパスのイテレータを受け取り、変換が終わったページから {"path", "page", "section", "text"} を返す
+
+        paths はリストのほか、キューから読み出すジェネレータも受け付ける。
+        同じPDF内のページはページ範囲の単位で返すため、順番が前後することがある。
+        on_file_done を指定すると、PDFの最後のページを返した後（ページがないPDFではすぐ）に
+        on_file_done(path, ok) を呼ぶ（ok は全ページ範囲をエラーなく変換できたかどうか）。中断したPDFでは呼ばない。
+        """
+        results = queue.Queue()
+        slots = threading.BoundedSemaphore(self.max_pending)
+        stop_event = threading.Event()
+        files = {}
+        futures = []
+        if self._executor is None:
+            # 呼び出し側のスレッド（バッチ送信など）が持つロックを fork で複製しないよう spawn を使う
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        feeder = threading.Thread(
+            target=self._feed,
+            args=(paths, self._executor, results, slots, stop_event, files, futures),
+            daemon=True
+        )
+        feeder.start()
+        consumed = 0
+        expected = None
+        try:
+            while expected is None or consumed < expected:
+                item = results.get()
+                if item[0] == "end":
+                    expected = item[1]
+                    continue
+                if item[0] == "done":
+                    if on_file_done is not None:
+                        on_file_done(item[1], True)
+                    continue
+                consumed += 1
+                slots.release()
+
+                path = item[1]
+                state = files[path]
+                state["remaining"] -= 1
+                if item[0] == "error":
+                    print(f"PDFの変換エラー: {path} - {item[2]}")
+                    state["failed"] = True
+                else:
+                    _, _, sections, pages, from_cache = item
+                    if from_cache:
+                        self.cache.hits += len(pages)
+                    else:
+                        self.cache.misses += len(pages)
+                        self.cache.put_pages(state["key"], pages)
+
+                    for page, text in pages:
+                        if text:
+                            yield {"path": path, "page": page, "section": sections[page - 1], "text": text}
+
+                if state["remaining"] == 0:
+                    # 全ページ変換できたPDFは次回から変換しない
+                    if not state["failed"]:
+                        self.cache.mark_complete(state["key"], state["page_count"])
+                    if on_file_done is not None:
+                        on_file_done(path, not state["failed"])
+        finally:
+            stop_event.set()
+            feeder.join(timeout=1)
+            # 途中で止めた場合は、この呼び出しで投入した残りのタスクだけを取り消す
+            for future in list(futures):
+                future.cancel()
+            wait(list(futures))
+
+    def extract(self, path):
+        """1つのPDFを変換し、ページ順のリストで返す"""
+        return sorted(self.iter_pages([path]), key=lambda page: page["page"])
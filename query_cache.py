@@ -0,0 +1,132 @@
+# 検索結果・ツール出力のキャッシュ（TTL + LRU）
+import os
+import time
+import hashlib
+import threading
+import unicodedata
+import contextvars
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# キャッシュの設定
+DEFAULT_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '256'))
+DEFAULT_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '3600'))  # 秒
+
+
+def normalize_query(query):
+    """全角・半角や大文字・小文字、空白の違いを吸収したクエリ文字列を返す"""
+    text = unicodedata.normalize('NFKC', str(query)).lower()
+    return " ".join(text.split())
+
+
+def vector_key(vector):
+    """クエリembeddingをキャッシュのキーに変換する"""
+    return hashlib.sha256(array('f', vector).tobytes()).hexdigest()
+
+
+class TTLCache:
+    """有効期限付きのLRUキャッシュ
+
+    件数が maxsize を超えると最も古く参照されたものから削除し、
+    ttl 秒を過ぎたものは取得時に破棄する。
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """キャッシュから値を返す（なければNone）"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """値をキャッシュに保存する"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self):
+        """キャッシュをすべて破棄する（データ更新時に呼ぶ）"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._data),
+            }
+
+
+class RetrievalContext:
+    """1回のエージェント実行の間だけ、クエリembeddingと検索結果を使い回す
+
+    ReActループ内で複数のツールがほぼ同じ入力で検索する場合に、
+    embeddingとベクトル検索の重複を省く。
+    """
+
+    def __init__(self):
+        self.vectors = {}  # 正規化したクエリ → embedding
+        self.results = {}  # 検索のキー → (k, 検索結果)
+        self.embed_calls = 0
+        self.search_calls = 0
+
+    def get_vector(self, query, embed):
+        """クエリのembeddingを返す（同じクエリは1回だけembeddingする）"""
+        key = normalize_query(query)
+        vector = self.vectors.get(key)
+        if vector is None:
+            vector = embed(query)
+            self.vectors[key] = vector
+            self.embed_calls += 1
+        return vector
+
+    def get_results(self, key, k, search):
+        """検索結果を返す（より大きなkで検索済みなら先頭k件を使う）"""
+        cached = self.results.get(key)
+        if cached is not None and cached[0] >= k:
+            return cached[1][:k]
+        docs = search()
+        self.results[key] = (k, docs)
+        self.search_calls += 1
+        return docs
+
+
+_retrieval_context = contextvars.ContextVar('retrieval_context', default=None)
+
+
+def current_retrieval_context():
+    """実行中のエージェントの検索コンテキストを返す（なければNone）"""
+    return _retrieval_context.get()
+
+
+@contextmanager
+def retrieval_scope():
+    """このブロックの間だけ有効な検索コンテキストを作成する"""
+    context = RetrievalContext()
+    token = _retrieval_context.set(context)
+    try:
+        yield context
+    finally:
+        _retrieval_context.reset(token)
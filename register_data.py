@@ -1,5 +1,6 @@
 # Weaviateのコレクションを作成し、データを追加するスクリプト 
 # import weaviate_control
+import sys
 import weaviate
 from weaviate.classes.config import Configure, Property, DataType, Tokenization
 
@@ -202,13 +203,25 @@ WEAVIATE_SCHEMA = {
     ]
 }
 
-client = weaviate.connect_to_local()
-client.collections.delete_all()  # 既存削除
-for class_def in WEAVIATE_SCHEMA["classes"]:
+# 使い方: python register_data.py [--recreate]
+# 既存のコレクションは残す。--recreate を付けた場合だけ、このスキーマのコレクションを削除して作り直す
+# （他のコレクションは削除しない）。embeddingモデルの変更は agent.py --reindex で検索を止めずに行える。
+if __name__ == "__main__":
+    recreate = "--recreate" in sys.argv[1:]
+    client = weaviate.connect_to_local()
+    try:
+        for class_def in WEAVIATE_SCHEMA["classes"]:
+            if client.collections.exists(class_def["class"]):
+                if not recreate:
+                    print(f"クラス '{class_def['class']}' は既に存在します")
+                    continue
+                client.collections.delete(class_def["class"])  # 既存削除
             print(f"クラス '{class_def['class']}' を作成中...")
             client.collections.create_from_dict(class_def)
+    finally:
+        client.close()
 
-print("Weaviateのスキーマを作成しました。")
+    print("Weaviateのスキーマを作成しました。")
 
 
 
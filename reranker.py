@@ -0,0 +1,170 @@
+# ベクトル検索後のリランク（再順位付け）
+import os
+import re
+import time
+import unicodedata
+
+# リランクの設定
+RERANK_MODES = ("none", "lexical", "cross-encoder")
+DEFAULT_RERANK_MODE = os.getenv('RERANK_MODE', 'none')  # none / lexical / cross-encoder
+DEFAULT_CROSS_ENCODER_MODEL = os.getenv('RERANK_MODEL', 'hotchpotch/japanese-reranker-cross-encoder-xsmall-v1')
+DEFAULT_RERANK_WEIGHT = float(os.getenv('RERANK_WEIGHT', '0.7'))  # リランクスコアの重み（残りは検索時のスコア）
+RERANK_BATCH_SIZE = int(os.getenv('RERANK_BATCH_SIZE', '32'))
+
+# 英数字の単語と、日本語（ひらがな・カタカナ・漢字）の連続
+_TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[぀-ヿ㐀-鿿]+')
+
+
+def tokenize(text):
+    """英数字は単語、日本語は文字bigramに分割する（形態素解析器なしで使える簡易トークナイザー）"""
+    tokens = []
+    for word in _TOKEN_PATTERN.findall(unicodedata.normalize('NFKC', text).lower()):
+        if word.isascii():
+            tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def _normalize_scores(scores):
+    """スコアを0〜1に正規化する"""
+    import numpy as np
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.size == 0:
+        return scores
+    low, high = float(scores.min()), float(scores.max())
+    if high - low < 1e-9:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def _retrieval_scores(docs):
+    """検索時のスコア（大きいほど関連が高い）を取り出す"""
+    scores = []
+    for rank, doc in enumerate(docs):
+        if doc.metadata.get("score") is not None:
+            scores.append(float(doc.metadata["score"]))
+        elif doc.metadata.get("distance") is not None:
+            scores.append(1.0 - float(doc.metadata["distance"]))
+        else:
+            scores.append(1.0 / (rank + 1))
+    return scores
+
+
+class LexicalReranker:
+    """候補チャンクの中だけでBM25を計算して並べ替える（モデル不要・CPUのみ）
+
+    クエリの語 × 候補チャンクの出現回数行列をまとめて作り、スコアを一括で計算する。
+    """
+
+    name = "lexical"
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def score(self, query, texts):
+        import numpy as np
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not texts:
+            return np.zeros(len(texts), dtype=np.float32)
+        term_index = {term: i for i, term in enumerate(terms)}
+
+        frequencies = np.zeros((len(texts), len(terms)), dtype=np.float32)
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            for token in tokens:
+                column = term_index.get(token)
+                if column is not None:
+                    frequencies[row, column] += 1
+
+        document_frequency = (frequencies > 0).sum(axis=0)
+        idf = np.log(1 + (len(texts) - document_frequency + 0.5) / (document_frequency + 0.5))
+        average_length = max(float(lengths.mean()), 1.0)
+        denominator = frequencies + self.k1 * (1 - self.b + self.b * lengths[:, np.newaxis] / average_length)
+        return ((frequencies * (self.k1 + 1) / denominator) * idf).sum(axis=1)
+
+
+class CrossEncoderReranker:
+    """ローカルのクロスエンコーダーで (クエリ, チャンク) の組をまとめて採点する
+
+    sentence-transformers が必要（pip install sentence-transformers）。
+    """
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name=DEFAULT_CROSS_ENCODER_MODEL, batch_size=RERANK_BATCH_SIZE):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def score(self, query, texts):
+        if not texts:
+            return []
+        return self.model.predict([(query, text) for text in texts], batch_size=self.batch_size)
+
+
+class RerankStage:
+    """検索結果を採点し直して上位だけを返す。直近の処理時間を記録する"""
+
+    def __init__(self, scorer, weight=DEFAULT_RERANK_WEIGHT):
+        self.scorer = scorer
+        self.weight = weight
+        self.last_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+        self.calls = 0
+
+    def rerank(self, query, docs, top_k):
+        """docs を query との関連度で並べ替えて上位 top_k 件を返す
+
+        元のDocumentは書き換えず、score にリランク後のスコア、
+        retrieval_score に検索時のスコアを入れたコピーを返す。
+        """
+        from langchain_core.documents import Document
+        started = time.perf_counter()
+        if not docs:
+            return []
+        rerank_scores = _normalize_scores(self.scorer.score(query, [doc.page_content for doc in docs]))
+        retrieval_scores = _retrieval_scores(docs)
+        combined = self.weight * rerank_scores + (1 - self.weight) * _normalize_scores(retrieval_scores)
+        order = sorted(range(len(docs)), key=lambda i: float(combined[i]), reverse=True)[:top_k]
+
+        reranked = []
+        for i in order:
+            metadata = dict(docs[i].metadata)
+            metadata["retrieval_score"] = retrieval_scores[i]
+            metadata["score"] = float(combined[i])
+            metadata.pop("distance", None)
+            reranked.append(Document(page_content=docs[i].page_content, metadata=metadata))
+
+        self.last_latency_ms = (time.perf_counter() - started) * 1000
+        self.total_latency_ms += self.last_latency_ms
+        self.calls += 1
+        return reranked
+
+    def stats(self):
+        """リランクの処理時間の統計を返す"""
+        return {
+            "scorer": self.scorer.name,
+            "calls": self.calls,
+            "last_latency_ms": self.last_latency_ms,
+            "average_latency_ms": self.total_latency_ms / self.calls if self.calls else 0.0,
+        }
+
+
+def create_rerank_stage(mode=DEFAULT_RERANK_MODE):
+    """設定に応じたリランクステージを返す（none の場合はNone）"""
+    if mode not in RERANK_MODES:
+        raise ValueError(f"不明なリランク方式です: {mode}（{', '.join(RERANK_MODES)}）")
+    if mode == "none":
+        return None
+    if mode == "cross-encoder":
+        try:
+            return RerankStage(CrossEncoderReranker())
+        except ImportError:
+            print("sentence-transformers がインストールされていないため、lexicalリランクを使用します")
+    return RerankStage(LexicalReranker())
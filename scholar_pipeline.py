@@ -0,0 +1,173 @@
+# arXivの論文をWeaviate（ScholarMetaDatas / ScholarChunks）に取り込むパイプライン
+#
+# 1. arxiv.harvest でメタデータ取得とPDFのダウンロード（スレッド）
+# 2. pdf_extract.PdfExtractor でページごとのMarkdownを抽出（プロセスプール）
+# 3. 論文とチャンクを参照付きでバッチ登録（呼び出し元スレッド。変換の終わったページから登録する）
+#    論文（ScholarMetaDatas）は全ページを変換できた後に登録し、登録済みの論文は次回スキップする。
+# ステージ間は上限付きのキューでつなぎ、検索結果全体を1回の実行で取り込む。
+#
+# 使い方: python scholar_pipeline.py ["検索クエリ"]
+import os
+import sys
+import time
+import queue
+import threading
+from datetime import datetime, timezone
+
+import weaviate
+from weaviate.util import generate_uuid5
+
+import arxiv
+from pdf_extract import PdfExtractor, DEFAULT_WORKERS
+from weaviate_control import WeaviateHandler
+
+META_COLLECTION = "ScholarMetaDatas"
+CHUNK_COLLECTION = "ScholarChunks"
+
+# パイプラインの設定
+pipeline_queue_size = int(os.getenv('SCHOLAR_QUEUE_SIZE', '16'))
+
+
+def meta_uuid(arxiv_id):
+    """論文の決定的なUUID（再実行しても重複しない）"""
+    return generate_uuid5(arxiv_id, META_COLLECTION)
+
+
+def build_meta_properties(meta_json, file_path):
+    return {
+        "title": meta_json["title"],
+        "abstract": meta_json.get("abstract", ""),
+        "authors": meta_json["authors"],
+        "journal": meta_json.get("journal", ""),
+        "year": str(meta_json["year"]),
+        "doi": meta_json.get("doi", ""),
+        "link": meta_json["link"],
+        "update_date": meta_json["update_date"],
+        "file_path": file_path,
+    }
+
+
+def build_chunk_properties(arxiv_id, page, ingestion_date):
+    return {
+        "content": page["text"],
+        "chunk_id": f"{arxiv_id}-p{page['page']}",
+        "chunk_index": page["page"],
+        "section": page["section"],
+        "usage_count": "0",
+        "ingestion_date": ingestion_date,
+    }
+
+
+def _put(item, target_queue, stop_event):
+    """キューが空くまで待って入れる（停止時はFalseを返す）"""
+    while not stop_event.is_set():
+        try:
+            target_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _harvest(search_query, extract_queue, stop_event, meta_collection):
+    """ダウンロードが終わった論文の (メタデータ, パス) をキューへ入れる
+
+    登録済みの論文は抽出せずにスキップする。論文は全ページの登録後に書き込むため、
+    変換に失敗した論文や中断した論文は次回もう一度取り込まれる。
+    """
+    def on_downloaded(meta_json, file_path):
+        if stop_event.is_set() or meta_collection.data.exists(meta_uuid(meta_json["arxiv_id"])):
+            return
+        _put((meta_json, file_path), extract_queue, stop_event)
+
+    try:
+        arxiv.harvest(search_query, on_downloaded=on_downloaded, stop_event=stop_event)
+    except Exception as e:
+        print(f"❌ Harvest error: {e}")
+    finally:
+        extract_queue.put(None)
+
+
+def ingest(client, search_query=arxiv.query, workers=None):
+    """検索クエリに一致する論文をダウンロードからWeaviateへの登録まで一括で行い、登録した論文数を返す"""
+    handler = WeaviateHandler(client)
+    handler.create_collection_meta(META_COLLECTION)
+    handler.create_collection_relateddata(CHUNK_COLLECTION, META_COLLECTION)
+    meta_collection = client.collections.get(META_COLLECTION)
+
+    ingestion_date = datetime.now(timezone.utc).isoformat()
+    extract_queue = queue.Queue(maxsize=max(1, pipeline_queue_size))
+    stop_event = threading.Event()
+    extractor = PdfExtractor(workers=workers or DEFAULT_WORKERS)
+    producer = threading.Thread(
+        target=_harvest,
+        args=(search_query, extract_queue, stop_event, meta_collection),
+        daemon=True
+    )
+    metas = {}  # PDFのパス → メタデータ
+
+    def downloaded_paths():
+        while True:
+            item = extract_queue.get()
+            if item is None:
+                return
+            meta_json, file_path = item
+            metas[file_path] = meta_json
+            yield file_path
+
+    started = time.perf_counter()
+    paper_count = 0
+    chunk_count = 0
+
+    producer.start()
+    try:
+        with client.batch.dynamic() as batch:
+            def on_file_done(file_path, ok):
+                nonlocal paper_count
+                meta_json = metas.pop(file_path)
+                # 論文は全ページのチャンクを登録した後に書き込む（スキップ判定に使うため）
+                if not ok:
+                    print(f"❌ Extraction failed, will retry next run: {meta_json['title']}")
+                    return
+                batch.add_object(
+                    collection=META_COLLECTION,
+                    properties=build_meta_properties(meta_json, file_path),
+                    uuid=meta_uuid(meta_json["arxiv_id"]),
+                )
+                paper_count += 1
+                print(f"🧩 Ingested: {meta_json['title']}")
+
+            for page in extractor.iter_pages(downloaded_paths(), on_file_done=on_file_done):
+                meta_json = metas[page["path"]]
+                arxiv_id = meta_json["arxiv_id"]
+                parent_uuid = meta_uuid(arxiv_id)
+                properties = build_chunk_properties(arxiv_id, page, ingestion_date)
+                batch.add_object(
+                    collection=CHUNK_COLLECTION,
+                    properties=properties,
+                    uuid=generate_uuid5(properties["chunk_id"], CHUNK_COLLECTION),
+                    references={"hasMetaData": parent_uuid},
+                )
+                chunk_count += 1
+    finally:
+        stop_event.set()
+        # 生産者スレッドがキュー待ちで止まらないよう残りを読み捨てる
+        while producer.is_alive():
+            try:
+                extract_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        extractor.close()
+
+    failed = client.batch.failed_objects
+    if failed:
+        print(f"❌ {len(failed)} objects failed. First error: {failed[0].message}")
+    elapsed = time.perf_counter() - started
+    print(f"✅ {paper_count} papers / {chunk_count} chunks ingested in {elapsed:.1f}s")
+    print(f"📄 Page cache: {extractor.cache.stats()}")
+    return paper_count
+
+
+if __name__ == "__main__":
+    with weaviate.connect_to_local() as client:
+        ingest(client, sys.argv[1] if len(sys.argv) > 1 else arxiv.query)
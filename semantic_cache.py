@@ -0,0 +1,141 @@
+# 質問の意味的な類似度による回答キャッシュ
+import os
+import time
+import threading
+import numpy as np
+
+# キャッシュの設定
+DEFAULT_CACHE_PATH = os.getenv('SEMANTIC_CACHE_PATH', '.cache/semantic_cache.npz')
+DEFAULT_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))  # コサイン類似度の閾値
+DEFAULT_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_SIZE', '1000'))
+
+
+class SemanticCache:
+    """質問のembeddingをNumPy行列で保持し、言い換えられた質問にも過去の回答を返す
+
+    行列は正規化済みのベクトルを並べたもので、検索は内積1回で行う。
+    scope（質問に含まれる特許番号や期間などの条件）が一致するエントリだけを返すため、
+    番号や年だけが違う質問に別の質問の回答を返すことはない。
+    件数が max_entries を超えると最も古く参照されたものから削除し、
+    save()/load() でnpzファイルに永続化する。
+    """
+
+    def __init__(self, embedder, model_name, path=DEFAULT_CACHE_PATH,
+                 threshold=DEFAULT_THRESHOLD, max_entries=DEFAULT_MAX_ENTRIES):
+        self.embedder = embedder
+        self.model_name = model_name
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+        self.load()
+
+    def _clear(self):
+        self.vectors = None  # (件数, 次元) のfloat32行列
+        self.questions = []
+        self.answers = []
+        self.scopes = []
+        self.last_used = np.zeros(0, dtype=np.float64)
+
+    def embed(self, question):
+        """質問を正規化済みのベクトルに変換する"""
+        vector = np.asarray(self.embedder.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, question, vector=None, scope=""):
+        """scope が同じで閾値以上に類似した過去の質問があれば (回答, ベクトル) を、なければ (None, ベクトル) を返す"""
+        if vector is None:
+            vector = self.embed(question)
+        with self._lock:
+            if self.vectors is not None and len(self.answers) and self.vectors.shape[1] == vector.shape[0]:
+                scores = self.vectors @ vector
+                scores[np.array([entry != scope for entry in self.scopes])] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.last_used[best] = time.time()
+                    self.hits += 1
+                    return self.answers[best], vector
+            self.misses += 1
+        return None, vector
+
+    def add(self, question, answer, vector=None, scope=""):
+        """質問と回答をキャッシュに追加する"""
+        if vector is None:
+            vector = self.embed(question)
+        with self._lock:
+            if self.vectors is None or self.vectors.shape[1] != vector.shape[0]:
+                self._clear()
+                self.vectors = np.empty((0, vector.shape[0]), dtype=np.float32)
+            self.vectors = np.vstack([self.vectors, vector[np.newaxis, :]])
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.scopes.append(scope)
+            self.last_used = np.append(self.last_used, time.time())
+
+            # 上限を超えたら最も古く参照されたものを削除する
+            if len(self.answers) > self.max_entries:
+                keep = np.sort(np.argsort(self.last_used)[-self.max_entries:])
+                self.vectors = self.vectors[keep]
+                self.questions = [self.questions[i] for i in keep]
+                self.answers = [self.answers[i] for i in keep]
+                self.scopes = [self.scopes[i] for i in keep]
+                self.last_used = self.last_used[keep]
+
+    def invalidate(self):
+        """キャッシュをすべて破棄する（データ更新時に呼ぶ）"""
+        with self._lock:
+            self._clear()
+
+    def load(self):
+        """ファイルからキャッシュを読み込む（embeddingモデルが違う場合やscopeのない古い形式は破棄する）"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data["model"]) != self.model_name or "scopes" not in data:
+                    return
+                with self._lock:
+                    self.vectors = data["vectors"].astype(np.float32)
+                    self.questions = [str(q) for q in data["questions"]]
+                    self.answers = [str(a) for a in data["answers"]]
+                    self.scopes = [str(s) for s in data["scopes"]]
+                    self.last_used = data["last_used"].astype(np.float64)
+        except Exception as e:
+            print(f"セマンティックキャッシュの読み込みエラー: {e}")
+            self._clear()
+
+    def save(self):
+        """キャッシュをファイルに保存する"""
+        with self._lock:
+            if self.vectors is None:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # 書き込み途中で壊れないよう一時ファイルに書いてから置き換える
+            tmp_path = self.path + ".tmp.npz"
+            np.savez(
+                tmp_path,
+                model=np.array(self.model_name),
+                vectors=self.vectors,
+                questions=np.array(self.questions, dtype=str),
+                answers=np.array(self.answers, dtype=str),
+                scopes=np.array(self.scopes, dtype=str),
+                last_used=self.last_used
+            )
+            os.replace(tmp_path, self.path)
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を返す"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.answers),
+        }
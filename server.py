@@ -0,0 +1,192 @@
+# 特許調査エージェントのHTTPサーバー
+# Weaviate接続・LLM・エージェントをプロセス起動時に1回だけ初期化し、
+# 複数のクライアントからの質問を同じプロセスで処理する。
+#
+# 使い方: python server.py [--host 127.0.0.1] [--port 8000]
+#   GET  /health                      : 稼働状況
+#   POST /query  {"question": "..."}  : 質問に回答
+#   POST /import {"file_path": "..."} : 特許データをインポート（SERVER_IMPORT_DIR 内のファイルのみ）
+# 認証はないため、既定ではlocalhostだけで待ち受ける。外部に公開する場合は --host を指定する。
+import os
+import json
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import agent
+
+# 同時に実行するLLM呼び出し数と、待ち行列に入れられるリクエスト数
+max_concurrent_queries = int(os.getenv('SERVER_MAX_CONCURRENT', '2'))
+max_waiting_queries = int(os.getenv('SERVER_MAX_WAITING', '32'))
+# /import で読み込めるディレクトリ（file_path はこの中の相対パスとして扱う）
+import_dir = os.getenv('SERVER_IMPORT_DIR', 'data')
+
+
+class QueryLimiter:
+    """実行中の質問数をセマフォで制限し、超えた分は待ち行列で待たせる
+
+    待ち行列も満杯の場合は受け付けない。
+    """
+
+    def __init__(self, max_concurrent, max_waiting):
+        self.max_waiting = max_waiting
+        self._semaphore = threading.BoundedSemaphore(max(1, max_concurrent))
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+
+    def acquire(self):
+        """実行枠を確保する。待ち行列が満杯ならFalseを返す"""
+        with self._lock:
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+        self._semaphore.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.running -= 1
+        self._semaphore.release()
+
+
+query_limiter = QueryLimiter(max_concurrent_queries, max_waiting_queries)
+# インポートは同時に1つだけ実行する
+import_lock = threading.Lock()
+
+
+def resolve_import_path(file_path):
+    """file_path を import_dir 内の実際のパスに変換する（ディレクトリの外を指す場合はNone）"""
+    base = os.path.realpath(import_dir)
+    path = os.path.realpath(os.path.join(base, file_path))
+    if os.path.commonpath([base, path]) != base:
+        return None
+    return path
+
+
+class PatentAgentHandler(BaseHTTPRequestHandler):
+    """/health, /query, /import を処理するハンドラ"""
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            weaviate_ready = agent.get_client().is_ready()
+        except Exception:
+            weaviate_ready = False
+        self._send_json(200 if weaviate_ready else 503, {
+            "status": "ok" if weaviate_ready else "degraded",
+            "weaviate": weaviate_ready,
+            "running_queries": query_limiter.running,
+            "waiting_queries": query_limiter.waiting,
+            "importing": import_lock.locked(),
+            "semantic_cache": agent.get_semantic_cache().stats(),
+            "tool_output_cache": agent.tool_output_cache.stats(),
+            "rerank": self._rerank_stats(),
+        })
+
+    def _rerank_stats(self):
+        if not agent.get_rerank_stage.is_initialized():
+            return None
+        rerank_stage = agent.get_rerank_stage()
+        return rerank_stage.stats() if rerank_stage is not None else None
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except (ValueError, UnicodeDecodeError):
+            self._send_json(400, {"error": "リクエストボディがJSONではありません"})
+            return
+        if not isinstance(body, dict):
+            self._send_json(400, {"error": "リクエストボディはJSONオブジェクトで指定してください"})
+            return
+
+        if self.path == "/query":
+            self._handle_query(body)
+        elif self.path == "/import":
+            self._handle_import(body)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _handle_query(self, body):
+        question = str(body.get("question", "")).strip()
+        if not question:
+            self._send_json(400, {"error": "questionを指定してください"})
+            return
+        if not query_limiter.acquire():
+            self._send_json(503, {"error": "混雑しています。しばらくしてから再度お試しください"})
+            return
+        try:
+            answer, from_cache = agent.run_agent(question)
+            self._send_json(200, {"answer": answer, "cached": from_cache})
+        except Exception as e:
+            self._send_json(500, {"error": f"エラーが発生しました: {e}"})
+        finally:
+            query_limiter.release()
+
+    def _handle_import(self, body):
+        file_path = str(body.get("file_path", "")).strip()
+        if not file_path:
+            self._send_json(400, {"error": "file_pathを指定してください"})
+            return
+        path = resolve_import_path(file_path)
+        if path is None:
+            self._send_json(403, {"error": f"file_pathは {import_dir} 内のファイルを指定してください"})
+            return
+        if not os.path.isfile(path):
+            self._send_json(404, {"error": f"ファイルが見つかりません: {file_path}"})
+            return
+        if not import_lock.acquire(blocking=False):
+            self._send_json(409, {"error": "別のインポートを実行中です"})
+            return
+        try:
+            imported = agent.import_patents_to_weaviate(agent.iter_patent_data(path))
+            self._send_json(200, {"imported": imported})
+        except Exception as e:
+            self._send_json(500, {"error": f"インポートエラー: {e}"})
+        finally:
+            import_lock.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="特許調査エージェントのHTTPサーバー")
+    parser.add_argument("--host", default=os.getenv('SERVER_HOST', '127.0.0.1'))
+    parser.add_argument("--port", type=int, default=int(os.getenv('SERVER_PORT', '8000')))
+    args = parser.parse_args()
+
+    # 接続・モデル・エージェントはリクエストを受け付ける前に1回だけ作成する
+    print("初期化中...")
+    agent.warm_up()
+
+    server = ThreadingHTTPServer((args.host, args.port), PatentAgentHandler)
+    server.daemon_threads = True
+    print(f"HTTPサーバーを起動しました: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nHTTPサーバーを停止します。")
+    finally:
+        server.server_close()
+        agent.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# patent_query の識別子抽出と照合用キーのテスト
+# 使い方: python -m unittest test_patent_query
+import unittest
+
+from patent_query import extract_identifiers, build_identifier_keys, extract_constraints
+
+
+class IdentifierKeyTest(unittest.TestCase):
+    """質問文から抽出した識別子と、登録時に作る照合用キーが一致することを確認する"""
+
+    def assert_patent_number_matches(self, stored, question):
+        keys = build_identifier_keys(stored, "", [])
+        self.assertEqual(extract_identifiers(question)["patent_numbers"], [keys["patent_number_key"]])
+
+    def test_patent_numbers(self):
+        for number in ["特許第6543210号", "特開2020-123456", "JP2020123456A", "US 10,123,456 B2", "ＵＳ１０１２３４５６Ｂ２"]:
+            with self.subTest(number=number):
+                self.assert_patent_number_matches(number, f"{number}の請求項を教えて")
+
+    def test_application_number(self):
+        keys = build_identifier_keys("", "特願2019-123456", [])
+        identifiers = extract_identifiers("特願 2019-123456 について")
+        self.assertEqual(identifiers["application_numbers"], [keys["application_number_key"]])
+
+    def test_classification_codes(self):
+        keys = build_identifier_keys("", "", ["G06N3/08", "h04l 9/32"])
+        identifiers = extract_identifiers("G06N 3/08 と H04L9/32 の特許")
+        self.assertEqual(identifiers["classification_codes"], keys["classification_keys"])
+
+    def test_unmatched_value_is_kept(self):
+        self.assertEqual(build_identifier_keys("abc 123", "", [])["patent_number_key"], "ABC123")
+
+
+class ConstraintTest(unittest.TestCase):
+    """検索条件を取り除いた後の検索用テキストを確認する"""
+
+    def test_full_classification_code_is_not_a_subclass(self):
+        constraints = extract_constraints("G06N 3/08のLiDAR関連特許")
+        self.assertEqual(constraints["classification_prefixes"], [])
+        self.assertNotIn("3/08", constraints["text"])
+
+    def test_company_affix_is_removed_with_alias(self):
+        for question in ["株式会社デンソーのLiDAR", "デンソー株式会社のLiDAR", "(株)デンソーのLiDAR"]:
+            with self.subTest(question=question):
+                constraints = extract_constraints(question)
+                self.assertIn("デンソー", constraints["assignees"])
+                self.assertEqual(constraints["text"], "のLiDAR")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,24 @@
+import atexit
 import pymupdf.pymupdf
+import random
 import weaviate
-from weaviate.classes.config import Configure, Property, DataType, ReferenceProperty
-from weaviate.classes.query import QueryReference
+from weaviate.classes.config import Configure, Reconfigure, Property, DataType, ReferenceProperty
+from weaviate.classes.query import QueryReference, Filter
+from query_cache import TTLCache
+from pdf_extract import PdfExtractor
+from index_profiles import (
+    vector_index_config, estimate_vector_memory, reconfigure_quantizer, default_pq_segments, wait_for_compression
+)
+
+# 参照先が削除されていたことを表すキャッシュの値
+_MISSING_TARGET = object()
 
 class WeaviateHandler:
 
     def __init__(self,client):
         self.client = client
 
-    def create_collection_meta(self, collection_name):
+    def create_collection_meta(self, collection_name, index_profile=None):
         if not self.client.collections.get(collection_name).exists():
             self.client.collections.create(
                 collection_name,
@@ -18,6 +28,7 @@ class WeaviateHandler:
                         # source_properties=["title"],
                         api_endpoint="http://host.docker.internal:11434",  # or "http://ollama:11434" if both in Docker
                         model="dengcao/Qwen3-Embedding-0.6B:F16",
+                        vector_index_config=vector_index_config(index_profile),
                     )
                 ],
                 generative_config=Configure.Generative.ollama(
@@ -51,7 +62,7 @@ class WeaviateHandler:
             print(f"Collection '{collection_name}' already exists.")
             
 
-    def create_collection_relateddata(self, collection_name, releated_collection_name):
+    def create_collection_relateddata(self, collection_name, releated_collection_name, index_profile=None):
         if not self.client.collections.get(collection_name).exists():
             # chunk class
             self.client.collections.create(
@@ -62,6 +73,7 @@ class WeaviateHandler:
                         # source_properties=["title"],
                         api_endpoint="http://host.docker.internal:11434",  # or "http://ollama:11434" if both in Docker
                         model="dengcao/Qwen3-Embedding-0.6B:F16",
+                        vector_index_config=vector_index_config(index_profile),
                     )
                 ],
                 generative_config=Configure.Generative.ollama(
@@ -73,6 +85,7 @@ class WeaviateHandler:
                     bm25_k1=1.25  # Set the 'k1' parameter
                 ),
                 properties=[
+                    Property(name="content",data_type=DataType.TEXT),
                     Property(name="chunk_id",data_type=DataType.TEXT),
                     Property(name="chunk_index",data_type=DataType.INT), #  index of the chunk in the
                     Property(name="section",data_type=DataType.TEXT),
@@ -102,11 +115,11 @@ class WeaviateHandler:
             print(f"Collection '{collection_name}' does not exist.")
 
 
-    def get_data(self, collection_name):
+    def get_data(self, collection_name, limit=5):
         if self.client.collections.get(collection_name).exists():
             data  = self.client.collections.get(collection_name).query.fetch_objects(
-                limit=5,
-                return_references=QueryReference(link_on="hasMeataData")
+                limit=limit,
+                return_references=QueryReference(link_on="hasMetaData")
             )
 
             return data
@@ -114,27 +127,225 @@ class WeaviateHandler:
             print(f"Collection '{collection_name}' does not exist.")
             return None
 
-import pymupdf4llm
-
-def extract_text_from_pdf(pdf_path):
-    
-    # PDFをロード
-    md_chunks = pymupdf4llm.to_markdown(
-    doc="pdf/sample.pdf",
-    page_chunks=True,
-    show_progress=True
-    )
-    # チャンク分割されたドキュメントを取得
-    docs = loader.load_and_split()
+
+    def _nearest_ids(self, collection, queries, k, vector_name):
+        """クエリごとの上位k件のUUIDを返す（クエリ自身のオブジェクトは除く）"""
+        results = []
+        for query_uuid, vector in queries:
+            response = collection.query.near_vector(
+                near_vector=vector,
+                limit=k + 1,
+                target_vector=vector_name,
+                return_properties=[],
+            )
+            ids = [obj.uuid for obj in response.objects if obj.uuid != query_uuid]
+            results.append(set(ids[:k]))
+        return results
+
+
+    def _sample_queries(self, collection, query_count, vector_name, seed=0):
+        """登録済みのオブジェクトから無作為に query_count 件選び、(UUID, ベクトル) のリストを返す
+
+        全件のUUIDをメモリに載せないよう、イテレータを1回なめるリザーバサンプリングで選ぶ。
+        """
+        rng = random.Random(seed)
+        chosen = []
+        for seen, obj in enumerate(collection.iterator(return_properties=[])):
+            if seen < query_count:
+                chosen.append(obj.uuid)
+            else:
+                slot = rng.randint(0, seen)
+                if slot < query_count:
+                    chosen[slot] = obj.uuid
+        if not chosen:
+            return []
+        response = collection.query.fetch_objects(
+            filters=Filter.by_id().contains_any(chosen),
+            limit=len(chosen),
+            include_vector=True,
+            return_properties=[],
+        )
+        return [
+            (obj.uuid, obj.vector[vector_name or "default"]) for obj in response.objects
+            if obj.vector.get(vector_name or "default")
+        ]
+
+
+    def _quantizer(self, collection, vector_name):
+        config = collection.config.get()
+        if vector_name:
+            return config.vector_config[vector_name].vector_index_config.quantizer
+        return config.vector_index_config.quantizer
+
+
+    def _physical_collection_name(self, collection_name):
+        """エイリアスなら参照先のコレクション名を、そうでなければ collection_name をそのまま返す"""
+        try:
+            alias = self.client.alias.get(alias_name=collection_name)
+        except Exception:
+            # エイリアスに対応していないサーバー（1.32未満）
+            return collection_name
+        return alias.collection if alias is not None else collection_name
+
+
+    def enable_compression(self, collection_name, method="pq", vector_name=None, queries=None,
+                           query_count=100, k=10, timeout=600):
+        """既存コレクションのベクトルを圧縮（PQ / BQ / SQ）し、メモリ使用量と検索精度の変化を返す
+
+        vector_name は名前付きベクトルの名前（Scholar* は "general_vector"、Patent は None）。
+        queries に (None, ベクトル) のリストを渡すとそれを held-out クエリに使い、
+        省略した場合は登録済みのベクトルから無作為に query_count 件選んで使う（自分自身は結果から除く）。
+        シャードの圧縮が終わってから検索し、圧縮前の検索結果に対する圧縮後の recall@k を recall として返す。
+        timeout 秒以内に圧縮が終わらない場合は、圧縮前の結果を測ることになるため recall は返さない。
+        collection_name にエイリアス（例: Patent）を渡した場合は、参照先のコレクションを圧縮する。
+        """
+        collection_name = self._physical_collection_name(collection_name)
+        if not self.client.collections.get(collection_name).exists():
+            print(f"Collection '{collection_name}' does not exist.")
+            return None
+        collection = self.client.collections.get(collection_name)
+        if self._quantizer(collection, vector_name) is not None:
+            print(f"Collection '{collection_name}' is already compressed.")
+            return None
+
+        count = collection.aggregate.over_all(total_count=True).total_count
+        if queries is None:
+            queries = self._sample_queries(collection, query_count, vector_name)
+        if not queries:
+            print(f"Collection '{collection_name}' has no vectors.")
+            return None
+        dimensions = len(queries[0][1])
+        segments = default_pq_segments(dimensions) if method == "pq" else None
+
+        baseline = self._nearest_ids(collection, queries, k, vector_name)
+
+        index_config = Reconfigure.VectorIndex.hnsw(quantizer=reconfigure_quantizer(method, segments))
+        if vector_name:
+            collection.config.update(
+                vectorizer_config=[Reconfigure.NamedVectors.update(name=vector_name, vector_index_config=index_config)]
+            )
+        else:
+            collection.config.update(vector_index_config=index_config)
+
+        # 設定は即座に反映されるが、ベクトルの圧縮はバックグラウンドで進むためシャードの状態で待つ
+        if not wait_for_compression(self.client, collection_name, timeout):
+            print(f"Collection '{collection_name}': compression did not finish within {timeout}s; "
+                  f"recall was not measured.")
+            return None
+
+        compressed = self._nearest_ids(collection, queries, k, vector_name)
+        recall = sum(len(a & b) / max(1, len(a)) for a, b in zip(baseline, compressed)) / len(queries)
+        report = {
+            "collection": collection_name,
+            "method": method,
+            "vectors": count,
+            "dimensions": dimensions,
+            "bytes_before": estimate_vector_memory(count, dimensions),
+            "bytes_after": estimate_vector_memory(count, dimensions, method, segments),
+            "recall": recall,
+            "recall_loss": 1 - recall,
+        }
+        print(f"Collection '{collection_name}' compressed with {method}: "
+              f"{count} vectors x {dimensions} dims, "
+              f"{report['bytes_before'] / 1024 ** 2:.1f}MB -> {report['bytes_after'] / 1024 ** 2:.1f}MB, "
+              f"recall@{k} {recall:.3f} (loss {report['recall_loss']:.3f}, {len(queries)} queries)")
+        return report
+
+
+    def iter_with_references(self, collection_name, link_on="hasMetaData", return_properties=None,
+                             target_properties=None, page_size=500, cache_size=10000):
+        """コレクションの全オブジェクトを、参照先のプロパティと一緒に (オブジェクト, 参照先のプロパティ) で返す
+
+        UUIDのカーソル（after）で page_size 件ずつ読み進め、参照先はページごとに
+        まとめて1回のクエリで取得する。取得済みの参照先はUUIDごとにキャッシュし、
+        同じ論文を参照するチャンクが続いても再取得しない。参照先が存在しない場合も記録し、
+        参照先のプロパティは None を返す。
+        return_properties / target_properties を指定すると、そのプロパティだけを取得する。
+        """
+        collection = self.client.collections.get(collection_name)
+        references = collection.config.get().references
+        reference = next((ref for ref in references if ref.name == link_on), None)
+        if reference is None:
+            names = ", ".join(ref.name for ref in references) or "none"
+            raise ValueError(f"Collection '{collection_name}' has no reference '{link_on}' (references: {names})")
+        target = self.client.collections.get(reference.target_collections[0])
+        targets = TTLCache(maxsize=cache_size, ttl=float("inf"))
+
+        cursor = None
+        while True:
+            # 参照はUUIDだけを受け取る（参照先のプロパティはページ単位でまとめて取得する）
+            page = collection.query.fetch_objects(
+                limit=page_size,
+                after=cursor,
+                return_properties=return_properties,
+                return_references=QueryReference(link_on=link_on, return_properties=[]),
+            )
+            if not page.objects:
+                break
+
+            target_uuids = {}
+            for obj in page.objects:
+                ref = (obj.references or {}).get(link_on)
+                target_uuids[obj.uuid] = str(ref.objects[0].uuid) if ref is not None and ref.objects else None
+
+            found = {}
+            missing = []
+            for target_uuid in set(target_uuids.values()) - {None}:
+                cached = targets.get(target_uuid)
+                if cached is None:
+                    missing.append(target_uuid)
+                elif cached is not _MISSING_TARGET:
+                    found[target_uuid] = cached
+            if missing:
+                response = target.query.fetch_objects(
+                    filters=Filter.by_id().contains_any(missing),
+                    return_properties=target_properties,
+                    limit=len(missing),
+                )
+                for obj in response.objects:
+                    found[str(obj.uuid)] = obj.properties
+                    targets.set(str(obj.uuid), obj.properties)
+                # 削除された参照先はページごとに問い合わせないよう、存在しないことを記録する
+                for target_uuid in set(missing) - set(found):
+                    targets.set(target_uuid, _MISSING_TARGET)
+
+            for obj in page.objects:
+                yield obj, found.get(target_uuids[obj.uuid])
+            cursor = page.objects[-1].uuid
+
+_pdf_extractor = None
+
+def get_pdf_extractor():
+    """extract_text_from_pdf で共有するPdfExtractorを返す（プロセスプールは終了時に閉じる）"""
+    global _pdf_extractor
+    if _pdf_extractor is None:
+        _pdf_extractor = PdfExtractor()
+        atexit.register(_pdf_extractor.close)
+    return _pdf_extractor
+
+def extract_text_from_pdf(pdf_path, extractor=None):
+    """PDFをページごとのMarkdownに変換し、{"page", "section", "text"} のリストを返す
+
+    section はそのページの目次（しおり）の見出し。ページ範囲ごとにプロセスプールで並列に変換し、
+    変換済みのページはPDFのハッシュをキーにしたキャッシュから返す。
+    extractor を省略すると、呼び出しをまたいで同じプロセスプールとキャッシュを使う。
+    """
     chunked_text = []
-    
+    for page in (extractor or get_pdf_extractor()).extract(pdf_path):
+        chunked_text.append({"page": page["page"], "section": page["section"], "text": page["text"]})
+
     return chunked_text
 
-with weaviate.connect_to_local() as client:
-    weaviate_hndl = WeaviateHandler(client)
-    # weaviate_hndl.create_collection_meta("ScholarMetaDatas")
-    # weaviate_hndl.create_collection_relateddata("ScholarChunks", "ScholarMetaDatas")
-    # weaviate_hndl.delete_collection("Question")
-    extracted_text = extract_text_from_pdf("pdf/sample.pdf")
+if __name__ == "__main__":
+    with weaviate.connect_to_local() as client:
+        weaviate_hndl = WeaviateHandler(client)
+        # weaviate_hndl.create_collection_meta("ScholarMetaDatas")
+        # weaviate_hndl.create_collection_relateddata("ScholarChunks", "ScholarMetaDatas")
+        # weaviate_hndl.delete_collection("Question")
+        # weaviate_hndl.enable_compression("ScholarChunks", method="pq", vector_name="general_vector")
+        # weaviate_hndl.enable_compression("Patent", method="bq")
+        # for chunk, meta in weaviate_hndl.iter_with_references("ScholarChunks", return_properties=["chunk_id"], target_properties=["title"]):
+        #     print(chunk.properties["chunk_id"], meta and meta["title"])
+        extracted_text = extract_text_from_pdf("pdf/sample.pdf")
 
 